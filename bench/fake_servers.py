@@ -0,0 +1,260 @@
+"""
+Fake Github REST, MSCBot and Matrix client-server APIs for benchmarking the
+bot offline. All three are served from one local HTTP server, and every
+request is counted by the API it was made to.
+
+Github is served at /, MSCBot at /mscbot, the TWIM feed at /twim/feed and
+Matrix at /_matrix.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse, parse_qs, unquote
+import threading
+import json
+import re
+
+# Github user ID of mscbot
+mscbot_user_id = 40832866
+
+# Labels MSCs are cycled through, by MSC number
+status_labels = ["proposal-in-review",
+                 "proposed-final-comment-period",
+                 "final-comment-period",
+                 "finished-final-comment-period"]
+
+labels = ["proposal",
+          "proposal-in-review",
+          "proposed-final-comment-period",
+          "final-comment-period",
+          "finished-final-comment-period",
+          "spec-pr-missing",
+          "spec-pr-in-review",
+          "merged"]
+
+
+def github_time(date):
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class FakeServers:
+    """
+    Generates a repository of MSCs and serves it. mscs, events and comments
+    are the number of open MSCs, label events per MSC and comments per MSC.
+    rate_limit is the number of Github requests allowed before Github starts
+    refusing them.
+    """
+
+    def __init__(self, mscs, events, comments, repo="bench/mscs", rate_limit=5000):
+        self.repo = repo
+        self.rate_limit = rate_limit
+        self.rate_limit_reset = int(datetime.now(timezone.utc).timestamp()) + 3600
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(self))
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+        self.repo_url = "%s/repos/%s" % (self.url, repo)
+
+        now = datetime.now(timezone.utc).replace(microsecond=0)
+        self.issues = []
+        self.events = {}
+        self.comments = {}
+        for number in range(mscs, 0, -1):
+            status = status_labels[number % len(status_labels)]
+            created = now - timedelta(days=60, hours=number)
+
+            # Label events spread over the last month, ending on the current status
+            history = ["proposal"] + status_labels[:status_labels.index(status) + 1]
+            self.events[number] = [{
+                "id": number * 1000 + i,
+                "url": "%s/issues/events/%d" % (self.repo_url, number * 1000 + i),
+                "event": "labeled",
+                "created_at": github_time(now - timedelta(days=30) + timedelta(
+                    days=30 * i / max(events, 1), hours=number % 24)),
+                "label": self.label(history[min(i, len(history) - 1)]),
+            } for i in range(events)]
+
+            # MSCBot comments last on MSCs in FCP
+            self.comments[number] = [{
+                "id": number * 1000 + i,
+                "url": "%s/issues/comments/%d" % (self.repo_url, number * 1000 + i),
+                "body": "Comment %d" % i,
+                "created_at": github_time(created + timedelta(hours=i)),
+                "user": {"id": mscbot_user_id if i == comments - 1 else 1000 + i,
+                         "login": "mscbot" if i == comments - 1 else "user%d" % i},
+            } for i in range(comments)]
+
+            issue = {
+                "id": number,
+                "number": number,
+                "title": "MSC%d: Proposal number %d" % (number, number),
+                "body": "Body of MSC%d. " % number * 20,
+                "state": "open",
+                "url": "%s/issues/%d" % (self.repo_url, number),
+                "html_url": "https://github.com/%s/issues/%d" % (repo, number),
+                "created_at": github_time(created),
+                "updated_at": github_time(now - timedelta(days=1)),
+                "user": {"id": 1, "login": "author"},
+                "labels": [self.label("proposal"), self.label(status)],
+            }
+            if number % 2 == 0:
+                issue["pull_request"] = {"html_url": issue["html_url"]}
+            self.issues.append(issue)
+
+        self.fcp_records = [{
+            "issue": {"number": issue["number"]},
+            "fcp": {"disposition": "merge"},
+            "reviews": [[{"login": "alice"}, True], [{"login": "bob"}, False]],
+        } for issue in self.issues if issue["number"] % len(status_labels) == 1]
+
+        self.twim_published = now - timedelta(days=5)
+
+    def label(self, name):
+        return {"name": name, "color": "ededed",
+                "url": "%s/labels/%s" % (self.repo_url, name)}
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, api):
+        with self.counts_lock:
+            self.counts[api] += 1
+
+    def snapshot_counts(self):
+        with self.counts_lock:
+            return Counter(self.counts)
+
+
+def make_handler(servers):
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections open like the real APIs do
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, data, status=200, headers=None):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_rate_limit()
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_empty(self, status, headers=None):
+            self.send_response(status)
+            self.send_rate_limit()
+            self.send_header("Content-Length", "0")
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+
+        def send_rate_limit(self):
+            """Send Github's rate limit headers"""
+            if urlparse(self.path).path.startswith("/repos/"):
+                with servers.counts_lock:
+                    remaining = max(servers.rate_limit - servers.counts["github"], 0)
+                self.send_header("X-RateLimit-Remaining", str(remaining))
+                self.send_header("X-RateLimit-Reset", str(servers.rate_limit_reset))
+                self.send_header("X-RateLimit-Resource", "core")
+
+        def send_page(self, items, query, etag_prefix=None):
+            """Serve a page of a list, with Github's Link header pagination"""
+            per_page = int(query.get("per_page", ["30"])[0])
+            page = int(query.get("page", ["1"])[0])
+            last = max((len(items) + per_page - 1) // per_page, 1)
+
+            headers = {}
+            if etag_prefix:
+                headers["ETag"] = '"%s-%d-%d"' % (etag_prefix, page, len(items))
+                if self.headers.get("If-None-Match") == headers["ETag"]:
+                    self.send_empty(304, headers)
+                    return
+
+            path = urlparse(self.path).path
+            links = []
+            params = {key: values[0] for key, values in query.items()}
+            for rel, number in (("next", page + 1), ("last", last)):
+                if rel == "next" and page >= last:
+                    continue
+                params["page"] = number
+                links.append('<%s%s?%s>; rel="%s"' % (
+                    servers.url, path, "&".join("%s=%s" % item for item in params.items()), rel))
+            if links:
+                headers["Link"] = ", ".join(links)
+
+            self.send_json(items[(page - 1) * per_page:page * per_page], headers=headers)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            path = url.path
+            repo_path = "/repos/" + servers.repo
+
+            if path.startswith("/mscbot/"):
+                servers.count("mscbot")
+                etag = '"fcp-%d"' % len(servers.fcp_records)
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_empty(304, {"ETag": etag})
+                else:
+                    self.send_json(servers.fcp_records, headers={"ETag": etag})
+                return
+
+            if path.startswith("/twim/"):
+                servers.count("twim")
+                body = ('<?xml version="1.0"?><rss version="2.0"><channel><title>TWIM</title>'
+                        '<item><title>This Week in Matrix</title><pubDate>%s</pubDate></item>'
+                        '</channel></rss>' % servers.twim_published.strftime(
+                            "%a, %d %b %Y %H:%M:%S +0000")).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/rss+xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+
+            servers.count("github")
+            if servers.snapshot_counts()["github"] > servers.rate_limit:
+                self.send_json({"message": "API rate limit exceeded"}, status=403)
+                return
+
+            if path == repo_path:
+                owner, name = servers.repo.split("/")
+                self.send_json({"id": 1, "name": name, "full_name": servers.repo,
+                                "owner": {"login": owner}, "url": servers.repo_url})
+            elif path == repo_path + "/labels":
+                self.send_page([servers.label(name) for name in labels], query)
+            elif path == repo_path + "/issues":
+                self.send_page(servers.issues, query, etag_prefix="issues")
+            else:
+                match = re.fullmatch(re.escape(repo_path) + r"/issues/(\d+)/(events|comments)",
+                                     path)
+                if match is None:
+                    self.send_json({"message": "Not Found"}, status=404)
+                    return
+                number = int(match.group(1))
+                items = servers.events if match.group(2) == "events" else servers.comments
+                self.send_page(items.get(number, []), query)
+
+        def do_PUT(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(length)
+
+            match = re.fullmatch(r"/_matrix/client/r0/rooms/([^/]+)/send/m\.room\.message/([^/]+)",
+                                 urlparse(self.path).path)
+            if match is None:
+                self.send_json({"errcode": "M_UNRECOGNIZED"}, status=404)
+                return
+
+            servers.count("matrix")
+            self.send_json({"event_id": "$%s:%s" % (match.group(2), unquote(match.group(1)))})
+
+    return Handler
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the bot's command handlers and daily summaries offline, against
+fake Github, MSCBot and Matrix servers (see fake_servers.py).
+
+Each scenario is run three ways:
+
+    cold     nothing cached, as after a restart without a saved snapshot
+    refresh  the MSC snapshot has expired, everything else is cached
+    warm     everything is cached
+
+and reports its latency (until the last message reached the fake
+homeserver), the number of requests made to each API, and with --memory,
+the peak memory allocated by Python while it ran.
+
+Run from the repository root:
+
+    python3 bench/run_bench.py --mscs 200 --rooms 50
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+from fake_servers import FakeServers, labels
+
+# Commands benchmarked, sent from a single room
+commands = ["show in-progress",
+            "show pending",
+            "show fcp",
+            "show all",
+            "show news since 4 weeks ago",
+            "show news twim",
+            "show stats",
+            "search proposal number 42",
+            "show summary"]
+
+apis = ["github", "mscbot", "twim", "matrix"]
+
+
+def configure_bot(servers, args):
+    """Point the bot at the fake servers, as main() would from config.toml"""
+    main.config = {
+        "github": {"token": "bench", "repo": servers.repo, "labels": labels,
+                   "base_url": servers.url, "max_concurrency": args.github_concurrency},
+        "mscbot": {"url": servers.url + "/mscbot"},
+        "matrix": {"user_id": "@mscbot:localhost", "token": "bench",
+                   "homeserver": servers.url, "message_type": "m.text"},
+        "bot": {"command": "mscbot", "daily_summary_time": "07:00"},
+        "cache": {"snapshot_ttl": 3600, "rendered_responses": 128},
+        "twim": {"feed_url": servers.url + "/twim/feed"},
+        "msc": {"fcp_length": 5},
+        "user_ids": {"bob": "@bob:localhost"},
+    }
+    main.logger = logging.getLogger("bench")
+    main.logger.setLevel(logging.INFO if args.verbose else logging.ERROR)
+    main.homeserver = servers.url
+    main.connect_github()
+
+    # Run the bot's event loop in the background, for outbound messages
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    async def start():
+        main.outbound_slots = asyncio.Semaphore(main.get_config("matrix", "send_concurrency", 4))
+
+    asyncio.run_coroutine_threadsafe(start(), loop).result()
+    main.loop = loop
+    main.command_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="command")
+
+
+def reset_caches():
+    """Forget everything the bot has cached"""
+    main.msc_snapshot = None
+    main.event_index = {}
+    main.fcp_start_index = {}
+    main.search_index.update(version=None, docs={}, postings={}, total_length=0)
+    main.render_cache.clear()
+    main.mscbot_cache = {"etag": None, "last_modified": None, "records": {}}
+    main.twim_cache.update(published=None, etag=None, last_modified=None)
+
+
+def expire_snapshot():
+    """Make the MSC snapshot due for a refresh"""
+    if main.msc_snapshot is not None:
+        main.msc_snapshot = dict(main.msc_snapshot, fetched_at=0)
+
+
+def measure(servers, run, expected_messages, trace_memory):
+    """
+    Run a scenario and wait for its messages to be delivered. Returns a
+    dictionary of the results.
+    """
+    before = servers.snapshot_counts()
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    start = time.perf_counter()
+    run()
+    deadline = time.monotonic() + 120
+    while servers.snapshot_counts()["matrix"] - before["matrix"] < expected_messages:
+        if time.monotonic() > deadline:
+            raise Exception("Timed out waiting for messages to be delivered")
+        time.sleep(0.001)
+    latency = time.perf_counter() - start
+
+    after = servers.snapshot_counts()
+    result = {"latency_ms": latency * 1000}
+    for api in apis:
+        result[api] = after[api] - before[api]
+    if trace_memory:
+        result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+    return result
+
+
+def run_scenario(servers, name, run, expected_messages, args):
+    """Run a scenario cold, after a snapshot refresh and warm"""
+    results = []
+    for mode, prepare in (("cold", reset_caches), ("refresh", expire_snapshot),
+                          ("warm", lambda: None)):
+        runs = []
+        for _ in range(1 if mode == "cold" else args.repeat):
+            prepare()
+            runs.append(measure(servers, run, expected_messages, args.memory))
+
+        # Median latency. Request counts are the same on every run
+        result = dict(runs[-1], scenario=name, mode=mode,
+                      latency_ms=statistics.median(r["latency_ms"] for r in runs))
+        results.append(result)
+        print(format_row(result, args.memory), flush=True)
+    return results
+
+
+def format_row(result, memory):
+    row = "%-30s %-8s %10.1f" % (result["scenario"], result["mode"], result["latency_ms"])
+    row += "".join(" %7d" % result[api] for api in apis)
+    if memory:
+        row += " %10.0f" % result["peak_kb"]
+    return row
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--mscs", type=int, default=100, help="Number of open MSCs")
+    parser.add_argument("--events", type=int, default=4, help="Label events per MSC")
+    parser.add_argument("--comments", type=int, default=10, help="Comments per MSC")
+    parser.add_argument("--rooms", type=int, default=20,
+                        help="Rooms receiving the daily summary")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Runs of each refresh and warm scenario")
+    parser.add_argument("--rate-limit", type=int, default=5000,
+                        help="Github requests the fake Github allows")
+    parser.add_argument("--github-concurrency", type=int, default=4,
+                        help="[github] max_concurrency")
+    parser.add_argument("--memory", action="store_true",
+                        help="Trace peak memory per scenario. Slows everything down")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="[%(levelname)s] %(message)s")
+    servers = FakeServers(args.mscs, args.events, args.comments, rate_limit=args.rate_limit)
+    servers.start()
+    configure_bot(servers, args)
+    if args.memory:
+        tracemalloc.start()
+
+    header = "%-30s %-8s %10s" % ("scenario", "mode", "ms")
+    header += "".join(" %7s" % api for api in apis)
+    if args.memory:
+        header += " %10s" % "peak KB"
+    print("%d MSCs, %d events and %d comments each, %d rooms" %
+          (args.mscs, args.events, args.comments, args.rooms))
+    print(header)
+
+    results = []
+    room_id = "!bench:localhost"
+    for command in commands:
+        results += run_scenario(servers, command,
+                                lambda: main.handle_command(room_id, command), 1, args)
+
+    room_ids = ["!bench%d:localhost" % i for i in range(args.rooms)]
+    results += run_scenario(servers, "daily summary x%d" % args.rooms,
+                            lambda: main.send_summary_batch(room_ids), args.rooms, args)
+
+    print("Peak RSS: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+    servers.stop()
+
+
+if __name__ == "__main__":
+    main_bench()
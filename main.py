@@ -4,15 +4,34 @@ A bot for matrix users to interact with and to be reminded about various events
 """
 
 from matrix_client.client import MatrixClient
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from collections import deque, namedtuple, OrderedDict, Counter
+from array import array
 from dateutil import parser
 from markdown import markdown
 from github import Github
+from github.GithubException import RateLimitExceededException
+from github.Issue import Issue
+from github.Label import Label
 from time import mktime
+from urllib.parse import quote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import feedparser
+import threading
+import asyncio
+import sqlite3
+import socket
+import atexit
+import gzip
+import hashlib
+import hmac
+import heapq
+import math
+import statistics
+import itertools
 import traceback
 import parsedatetime
-import schedule
 import time
 import toml
 import json
@@ -24,10 +43,101 @@ import re
 
 # Matrix client
 client = None
+# Base URL of the homeserver
+homeserver = None
+# Room ID to queue of messages waiting to be sent to that room. See send_message()
+outbound_queues = {}
+# Limits how many rooms messages are sent to at once. See deliver_messages()
+outbound_slots = None
+# Time (as a unix timestamp) until which the homeserver has asked us to back off
+outbound_backoff_until = 0
+# HTTP session messages are sent with. See put_message()
+outbound_session = None
+# Source of transaction IDs for sent messages, unique across restarts. They
+# are prefixed with the worker ID to keep them unique across workers too
+outbound_txn_ids = itertools.count(int(time.time() * 1000))
+# Counts and delivery latency of outbound messages. See outbound_status()
+outbound_stats = {"sent": 0, "dropped": 0, "superseded": 0, "rate_limited": 0,
+                  "latency_total": 0.0, "latency_max": 0.0}
+# asyncio event loop the bot runs on. See run_bot()
+loop = None
+# Thread pool that blocking command handlers and summaries are run in
+command_pool = None
+# Room ID to queue of pending tasks for that room. See queue_room_task()
+room_queues = {}
+# IDs of rooms currently being joined. See queue_join()
+pending_joins = set()
+# Metric name and label tuple to counter or gauge value, or histogram. See observe()
+metrics = {}
+metrics_lock = threading.Lock()
+# Upper bounds, in seconds, of the buckets of every histogram
+metric_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Metric name to (type, description)
+metric_descriptions = {
+    "mscbot_command_seconds": ("histogram", "Time taken to handle a command, by command ID"),
+    "mscbot_upstream_request_seconds": ("histogram", "Duration of requests to upstream services"),
+    "mscbot_upstream_errors_total": ("counter", "Requests to upstream services that failed"),
+    "mscbot_github_rate_limit_remaining": ("gauge", "Github API requests left this rate limit window"),
+    "mscbot_cache_lookups_total": ("counter", "Cache lookups, by cache and hit or miss"),
+    "mscbot_summary_delivery_lag_seconds": ("histogram",
+                                            "Time from a daily summary falling due to its delivery"),
+    "mscbot_loop_lag_seconds": ("histogram", "How late the event loop runs a task it scheduled"),
+    "mscbot_outbound_queued_messages": ("gauge", "Messages waiting to be sent"),
+    "mscbot_outbound_oldest_message_age_seconds": ("gauge",
+                                                   "Seconds the oldest waiting message has waited"),
+    "mscbot_outbound_messages_total": ("counter", "Outbound messages, by outcome"),
+    "mscbot_snapshot_version": ("gauge", "Version of the MSC snapshot"),
+    "mscbot_snapshot_age_seconds": ("gauge", "Seconds since the MSC snapshot was fetched"),
+    "mscbot_cluster_leader": ("gauge", "Whether this worker holds the cluster leader lease"),
+}
+# Set to wake the scheduler up when the schedule changes. See run_scheduler()
+scheduler_wakeup = None
+# Daily summary time ("HH:MM" UTC) to set of IDs of rooms with a summary at
+# that time
+summary_buckets = {}
+# Room ID to the daily summary time it is scheduled at
+summary_room_times = {}
+# Heap of (next fire time as a unix timestamp, daily summary time) tuples,
+# one for each entry in summary_buckets
+summary_heap = []
 # Github API client
 github = None
 # Github repo object
 repo = None
+# Github priority class to thread pool for concurrent per-issue Github
+# requests. See fetch_concurrently()
+github_pools = {}
+# Github requests are made in priority classes. Waiting requests of lower
+# numbered classes go first, and higher numbered classes stop earlier when the
+# rate limit runs low. See github_priority()
+github_priorities = {"summary": 0, "command": 1, "refresh": 2, "backfill": 3}
+# Requests each priority class leaves in a rate limit window for more
+# important ones, unless configured with [github] budget_reserve
+github_default_reserves = {"summary": 0, "command": 100, "refresh": 500, "backfill": 1000}
+# Github rate limit resource ("core" or "graphql") to its remaining requests
+# and reset time (as a unix timestamp). See update_github_budget()
+github_budget = {}
+# Limits the Github requests in flight. See github_request_slot()
+github_gate = threading.Condition()
+# Heap of (priority, ticket number) of requests waiting at the gate
+github_gate_waiting = []
+github_gate_tickets = itertools.count()
+github_requests_in_flight = 0
+# Priority class of the Github requests made by each thread
+github_context = threading.local()
+# Time (as a unix timestamp) until which Github has asked us to back off
+github_backoff_until = 0
+# HTTP session for the Github GraphQL API. See graphql_query()
+graphql_session = None
+# Pooled HTTP session for the MSCBot API. See fetch_fcp_records()
+mscbot_session = None
+# Last MSCBot response, kept for conditional revalidation
+mscbot_cache = {"etag": None, "last_modified": None, "records": {}}
+# Date of the last TWIM post, and the feed's validators for revalidating it.
+# See refresh_twim_feed()
+twim_cache = {"published": None, "etag": None, "last_modified": None}
+# HTTP session for the TWIM RSS feed
+twim_session = None
 # Github Label objects for each label in the repo
 msc_labels = None
 # Config file object
@@ -36,9 +146,93 @@ config = None
 logger = None
 # Room ID to room-settings dictionary mapping
 room_specific_data = {}
+# Lock guarding room_specific_data and saving it
+room_data_lock = threading.RLock()
+# IDs of rooms whose settings changed since they were last saved
+dirty_rooms = set()
+# Timer that saves changed room settings. See schedule_room_data_save()
+room_data_save_timer = None
+# Connection to the room settings database, if the sqlite backend is used
+room_data_db = None
+# Connection to the store shared by the workers of a cluster. See
+# connect_cluster()
+cluster_db = None
+# Lock guarding cluster_db
+cluster_db_lock = threading.Lock()
+# ID of this worker, unique within the cluster
+worker_id = "%s-%d" % (socket.gethostname(), os.getpid())
+# Unix timestamp until which this worker holds the leader lease. See
+# renew_lease()
+leader_until = 0
+# Shared store key to the revision of it this worker last loaded or saved
+cluster_revisions = {}
+# Version of the MSC snapshot last shared with or loaded from the cluster
+shared_snapshot_version = None
+# IDs of rooms with a daily summary waiting to be sent in the next batch, to
+# the time (as a unix timestamp) the summary fell due. See queue_summary()
+pending_summaries = {}
+# Process-wide snapshot of MSC metadata, shared between all rooms.
+# See get_snapshot()
+msc_snapshot = None
+# Lock held while the MSC snapshot is being refreshed
+snapshot_lock = threading.Lock()
+# Least-recently-used cache of rendered (plain body, HTML body) responses.
+# See render_cached()
+render_cache = OrderedDict()
+# Lock guarding render_cache
+render_cache_lock = threading.Lock()
+# Issue number (as a string) to label-added events and high-water mark
+# mapping, persisted to disk. See update_event_index()
+event_index = {}
+# Lock held while the event index is being updated
+event_index_lock = threading.Lock()
+# Incremented whenever the event index changes. See event_index_changed()
+event_index_version = 0
+# MSC lifecycle stages, in order
+lifecycle_stages = ["proposal",
+                    "proposed-final-comment-period",
+                    "final-comment-period",
+                    "finished-final-comment-period",
+                    "merged"]
+# Display names of lifecycle stages, and their shorter table column headings
+stage_names = {"proposal": "Proposal",
+               "proposed-final-comment-period": "Proposed FCP",
+               "final-comment-period": "FCP",
+               "finished-final-comment-period": "Finished FCP",
+               "merged": "Merged"}
+stage_columns = {"proposal": "proposed",
+                 "proposed-final-comment-period": "pfcp",
+                 "final-comment-period": "fcp",
+                 "finished-final-comment-period": "finished",
+                 "merged": "merged"}
+# When each MSC in the event index entered each lifecycle stage, built from
+# the event index. See get_lifecycle_index()
+lifecycle_index = None
+# Inverted index over the titles, bodies and labels of the MSCs in the
+# snapshot. See update_search_index()
+search_index = {"version": None, "docs": {}, "postings": {}, "total_length": 0}
+search_index_lock = threading.Lock()
+# Weight of a term appearing in each field of an MSC
+search_field_weights = {"title": 3, "labels": 2, "body": 1}
+search_term_regex = re.compile(r"[a-z0-9]+")
+# Issue number (as a string) to FCP start time mapping, invalidated whenever
+# the issue is updated. See get_fcp_start()
+fcp_start_index = {}
+# Labels of MSCs that have not passed final comment period yet
+active_msc_labels = frozenset(["proposal-in-review",
+                               "proposed-final-comment-period",
+                               "final-comment-period"])
+# Github user ID of mscbot, which comments when an FCP starts
+# (retrieve from `curl -A 'mscbot' https://api.github.com/users/mscbot`)
+mscbot_user_id = 40832866
 # Regex for replacing Matrix IDs with formatted pills
 pill_regex = re.compile(r"@([a-z0-9A-Z]+):([a-z0-9A-Z]+)\.([a-z]+)")
 
+# A proposed FCP as reported by MSCBot
+FcpRecord = namedtuple("FcpRecord", ["issue_number", "disposition", "reviews"])
+# A team member's review of a proposed FCP
+FcpReview = namedtuple("FcpReview", ["login", "approved"])
+
 # Available bot commands and their variants.
 # Certain commands can accept parameters which should immediately follow the
 # command text
@@ -51,6 +245,8 @@ known_commands = {
     "SHOW_SUMMARY": ["show summary", "summarize", "summarise"],
     "SHOW_NEWS": ["show news"],
     "SHOW_TASKS": ["show tasks"],
+    "SHOW_STATS": ["show stats", "show statistics"],
+    "SHOW_SEARCH": ["show search", "search"],
     "HELP": ["help", "show help"],
 
     # Room-specific commands
@@ -70,6 +266,43 @@ known_commands = {
     "ROOM_PRIORITY_MSCS": ["set priority mscs", "set priority"],
 }
 
+# Command variant to command ID mapping
+command_variants = {variant: command_id
+                    for command_id, variants in known_commands.items()
+                    for variant in variants}
+# Matches the longest command variant a command starts with. Alternatives are
+# tried in order, so longer variants are listed first
+command_regex = re.compile("|".join(
+    re.escape(variant) for variant in sorted(command_variants, key=len, reverse=True)))
+
+# Command ID to handler mapping. See command_handler()
+command_handlers = {}
+
+
+def command_handler(command_id, needs=(), cached=False):
+    """
+    Registers a function as the handler of a command. Handlers are called
+    with the room ID, a list of arguments and the room's view of the MSC
+    snapshot, and return the markdown response (or None if they responded
+    themselves).
+
+    needs declares the data loaded for the handler before it is called. The
+    only such data is "snapshot", MSC metadata from the shared snapshot.
+    Handlers that don't need it are passed None instead of MSCs. Other data,
+    such as the label event index or the TWIM feed, is fetched by the
+    handlers that read it.
+
+    If cached is True, responses are cached per snapshot version, room
+    priority MSCs and arguments. See render_cached().
+    """
+    if not set(needs) <= {"snapshot"}:
+        raise ValueError("Unknown data needed by %s: %s" % (command_id, needs))
+
+    def register(handler):
+        command_handlers[command_id] = {"handler": handler, "needs": needs, "cached": cached}
+        return handler
+    return register
+
 
 # Custom variadic functions for logging purposes
 def log_info(*args, trace=False):
@@ -96,188 +329,764 @@ def log_fatal(*args, trace=True):
     logger.fatal(err)
 
 
+def log_background_error(future):
+    """Done callback that logs the exception of a background task, if any"""
+    if not future.cancelled() and future.exception() is not None:
+        e = future.exception()
+        log_warn("Background task failed:",
+                 "".join(traceback.format_exception(type(e), e, e.__traceback__)), trace=False)
+
+
+# Metrics, served in the Prometheus text format. See render_metrics()
+def observe(name, labels, value):
+    """Add an observation to a histogram"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        histogram = metrics.get(key)
+        if histogram is None:
+            histogram = metrics[key] = {"buckets": [0] * len(metric_buckets),
+                                        "sum": 0.0, "count": 0}
+        for i, bound in enumerate(metric_buckets):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def increment(name, labels, value=1):
+    """Increase a counter"""
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        metrics[key] = metrics.get(key, 0) + value
+
+
+def set_gauge(name, labels, value):
+    """Set a gauge"""
+    with metrics_lock:
+        metrics[(name, tuple(sorted(labels.items())))] = value
+
+
+def count_cache_lookup(cache, hit, lookups=1):
+    """Count hits or misses of one of the bot's caches"""
+    increment("mscbot_cache_lookups_total", {"cache": cache, "result": "hit" if hit else "miss"},
+              lookups)
+
+
+class track_request:
+    """
+    Context manager timing a request to an upstream service, and counting
+    it, and whether it raised, in the upstream request metrics
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        labels = {"upstream": self.upstream}
+        observe("mscbot_upstream_request_seconds", labels, time.perf_counter() - self.start)
+        if exc_type is not None:
+            increment("mscbot_upstream_errors_total", labels)
+
+
+def format_labels(labels, extra=()):
+    """Format label pairs the way Prometheus expects"""
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace("\\", "\\\\")
+                                                          .replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text format"""
+    # Gauges that are cheaper to read when scraped than to keep up to date.
+    # The outbound queues belong to the event loop, so are read from it
+    try:
+        status = asyncio.run_coroutine_threadsafe(get_outbound_status(), loop).result(timeout=5)
+    except Exception:
+        log_warn("Unable to read outbound queue status for metrics")
+    else:
+        set_gauge("mscbot_outbound_queued_messages", {}, status["queued"])
+        set_gauge("mscbot_outbound_oldest_message_age_seconds", {}, status["oldest_age"])
+        for outcome in ("sent", "dropped", "superseded", "rate_limited"):
+            set_gauge("mscbot_outbound_messages_total", {"outcome": outcome}, status[outcome])
+    snapshot = msc_snapshot
+    if snapshot is not None:
+        set_gauge("mscbot_snapshot_version", {}, snapshot["version"])
+        set_gauge("mscbot_snapshot_age_seconds", {}, time.time() - snapshot["fetched_at"])
+
+    with metrics_lock:
+        items = sorted(metrics.items(), key=lambda item: item[0])
+        lines = []
+        last_name = None
+        for (name, labels), value in items:
+            if name != last_name:
+                kind, description = metric_descriptions[name]
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, kind))
+                last_name = name
+
+            if kind != "histogram":
+                lines.append("%s%s %s" % (name, format_labels(labels), value))
+                continue
+
+            for bound, bucket in zip(metric_buckets, value["buckets"]):
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels, [("le", bound)]),
+                                                 bucket))
+            lines.append("%s_bucket%s %d" % (name, format_labels(labels, [("le", "+Inf")]),
+                                             value["count"]))
+            lines.append("%s_sum%s %f" % (name, format_labels(labels), value["sum"]))
+            lines.append("%s_count%s %d" % (name, format_labels(labels), value["count"]))
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves metrics to Prometheus"""
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server():
+    """Serve metrics from a background thread"""
+    address = (get_config("metrics", "host", "127.0.0.1"), get_config("metrics", "port", 9110))
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log_info("Serving metrics on %s:%d" % address)
+
+
+def instrument_github(github):
+    """
+    Make every request of a Github client within the rate limit budget of its
+    priority class, timed, and tracking the rate limit. See
+    github_request_slot()
+    """
+    requester = github.requester
+    request_json = requester.requestJson
+
+    def timed_request_json(*args, **kwargs):
+        with github_request_slot("core"), track_request("github"):
+            status, headers, output = request_json(*args, **kwargs)
+        if status == 304:
+            count_cache_lookup("github_etag", True)
+        update_github_budget(headers)
+        return status, headers, output
+
+    requester.requestJson = timed_request_json
+
+
+def get_config(section, key, default_value=None):
+    """Retreives a config value if it exists, otherwise returns default_value"""
+    global config
+
+    if section in config and key in config[section]:
+        return config[section][key]
+    return default_value
+
+
 def get_room_setting(room_id, setting_key, default_value=None):
     """Retreives a room setting if it exists, otherwise returns default_value"""
     global room_specific_data
 
-    if room_id in room_specific_data and setting_key in room_specific_data[room_id]:
-        return room_specific_data[room_id][setting_key]
+    with room_data_lock:
+        if room_id in room_specific_data and setting_key in room_specific_data[room_id]:
+            return room_specific_data[room_id][setting_key]
     return default_value
 
 
 def update_room_setting(room_id, setting_dict):
     """
-    Update a room-specific setting and save to disk. Params are room ID
-    string and a dictionary with custom key/value data.
+    Update a room-specific setting and schedule saving it to disk. Params are
+    room ID string and a dictionary with custom key/value data.
     """
-    global config
     global room_specific_data
 
-    # Update or insert settings dict under room_id key
-    if room_id not in room_specific_data:
-        room_specific_data[room_id] = setting_dict
-    else:
-        room_specific_data[room_id].update(setting_dict)
-
-    # Backup old room data if available
-    data_filepath = config["bot"]["data_filepath"]
-    if os.path.exists(data_filepath):
-        os.rename(data_filepath, data_filepath + ".bak")
+    with room_data_lock:
+        # Update or insert settings dict under room_id key
+        if room_id not in room_specific_data:
+            room_specific_data[room_id] = setting_dict
+        else:
+            room_specific_data[room_id].update(setting_dict)
 
-    # Save updated data to disk
-    try:
-        with open(data_filepath, 'w') as f:
-            json.dump(room_specific_data, f)
-    except:
-        log_warn("Unable to save room data to disk")
+        dirty_rooms.add(room_id)
+        schedule_room_data_save()
 
 
 def delete_room_setting(room_id, setting_key):
     """Removes a setting from a room"""
-    global config
     global room_specific_data
 
+    with room_data_lock:
+        try:
+            room_specific_data[room_id].pop(setting_key, None)
+        except:
+            log_warn("Tried to delete room key '%s' that did not exist on room '%s'." % (
+            setting_key, room_id))
+            return
+
+        dirty_rooms.add(room_id)
+        schedule_room_data_save()
+
+
+def schedule_room_data_save():
+    """
+    Save changed room settings after [bot] data_save_delay seconds, so that a
+    burst of changes is written out once
+    """
+    global room_data_save_timer
+
+    delay = get_config("bot", "data_save_delay", 1)
+    with room_data_lock:
+        if delay <= 0:
+            save_room_data()
+        elif room_data_save_timer is None:
+            room_data_save_timer = threading.Timer(delay, save_room_data)
+            room_data_save_timer.daemon = True
+            room_data_save_timer.start()
+
+
+def save_room_data():
+    """Save changed room settings to disk"""
+    global room_data_save_timer
+
+    with room_data_lock:
+        room_data_save_timer = None
+        if len(dirty_rooms) == 0:
+            return
+
+        try:
+            if room_data_db:
+                # Only the rows of rooms that changed are written
+                with room_data_db:
+                    room_data_db.executemany(
+                        "INSERT OR REPLACE INTO room_settings (room_id, settings) VALUES (?, ?)",
+                        [(room_id, json.dumps(room_specific_data[room_id]))
+                         for room_id in dirty_rooms])
+                    if cluster_enabled():
+                        # Tell the other workers to reload room settings
+                        put_shared_state(room_data_db, "room_settings", b"")
+            else:
+                write_json_atomically(config["bot"]["data_filepath"], room_specific_data)
+            dirty_rooms.clear()
+        except:
+            log_warn("Unable to save room data to disk")
+
+
+def load_room_data():
+    """Retrieve room-specific data from disk if it exists"""
+    global room_specific_data
+    global room_data_db
+
+    data_filepath = get_config("bot", "data_filepath")
+    room_data = {}
+    if data_filepath and os.path.exists(data_filepath):
+        with open(data_filepath, 'r') as f:
+            room_data = json.loads(f.read())
+
+    if cluster_enabled():
+        # Room settings are shared by all workers
+        room_data_db = open_shared_database()
+    elif get_config("bot", "data_backend", "json") == "sqlite":
+        room_data_db = sqlite3.connect(config["bot"]["database_filepath"],
+                                       check_same_thread=False)
+    if room_data_db:
+        with room_data_db:
+            room_data_db.execute("CREATE TABLE IF NOT EXISTS room_settings "
+                                 "(room_id TEXT PRIMARY KEY, settings TEXT NOT NULL)")
+        rows = room_data_db.execute("SELECT room_id, settings FROM room_settings").fetchall()
+        if len(rows) > 0:
+            room_data = {room_id: json.loads(settings) for room_id, settings in rows}
+        elif len(room_data) > 0:
+            # First run with the sqlite backend. Import the JSON file
+            log_info("Importing room data from", data_filepath)
+            dirty_rooms.update(room_data.keys())
+
+    with room_data_lock:
+        room_specific_data = room_data
+        save_room_data()
+
+    # Don't lose changes that are waiting to be saved on exit
+    atexit.register(save_room_data)
+
+
+def write_json_atomically(filepath, data, compress=False):
+    """
+    Write data to filepath as JSON, gzipped if compress is True. The file is
+    written to a temporary file, synced to disk and then renamed over the
+    original, so a crash leaves either the old or the new contents, never a
+    partial file.
+    """
+    encoded = json.dumps(data).encode()
+    if compress:
+        encoded = gzip.compress(encoded)
+
+    temp_filepath = filepath + ".tmp"
+    with open(temp_filepath, 'wb') as f:
+        f.write(encoded)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_filepath, filepath)
+
+    # Make sure the rename itself survives a crash
+    dir_fd = os.open(os.path.dirname(os.path.abspath(filepath)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+# Multi-worker deployments. Workers share the MSC snapshot, event index and
+# room settings through a SQLite database, and the worker holding the leader
+# lease sends daily summaries and refreshes the snapshot from Github
+def cluster_enabled():
+    """Returns whether this bot is one worker of a cluster"""
+    return get_config("cluster", "enabled", False)
+
+
+def open_shared_database():
+    """Opens a connection to the cluster's shared database"""
+    db = sqlite3.connect(config["cluster"]["database_filepath"], check_same_thread=False,
+                         timeout=get_config("cluster", "busy_timeout", 10))
+    # Let workers read while another one writes
+    db.execute("PRAGMA journal_mode=WAL")
+    return db
+
+
+def connect_cluster():
+    """Connect to the cluster's shared database, creating its tables"""
+    global cluster_db
+    global worker_id
+
+    worker_id = get_config("cluster", "worker_id", worker_id)
+    cluster_db = open_shared_database()
+    with cluster_db_lock, cluster_db:
+        cluster_db.execute("CREATE TABLE IF NOT EXISTS leases "
+                           "(name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        cluster_db.execute("CREATE TABLE IF NOT EXISTS shared_state "
+                           "(key TEXT PRIMARY KEY, revision INTEGER NOT NULL, data BLOB NOT NULL, "
+                           "updated_at REAL NOT NULL)")
+        cluster_db.execute("CREATE TABLE IF NOT EXISTS claims "
+                           "(name TEXT PRIMARY KEY, worker TEXT NOT NULL, claimed_at REAL NOT NULL)")
+    log_info("Joined cluster as worker", worker_id)
+
+    # Let another worker take over straight away on a clean exit
+    atexit.register(release_lease)
+
+
+def put_shared_state(db, key, data):
+    """
+    Saves a value under a key of the shared store, bumping its revision. Runs
+    in the caller's transaction on db
+    """
+    db.execute("INSERT INTO shared_state (key, revision, data, updated_at) VALUES (?, 1, ?, ?) "
+               "ON CONFLICT(key) DO UPDATE SET revision = revision + 1, data = excluded.data, "
+               "updated_at = excluded.updated_at", (key, data, time.time()))
+
+
+def store_put(key, data):
+    """Saves a value to the shared store, and remembers its revision as seen"""
+    with cluster_db_lock, cluster_db:
+        put_shared_state(cluster_db, key, data)
+        revision = cluster_db.execute("SELECT revision FROM shared_state WHERE key = ?",
+                                      (key,)).fetchone()[0]
+    cluster_revisions[key] = revision
+
+
+def store_get(key, since=0):
+    """
+    Returns a tuple of the revision, value and update time of a key of the
+    shared store, or None if it has no revision newer than since
+    """
+    with cluster_db_lock:
+        return cluster_db.execute("SELECT revision, data, updated_at FROM shared_state "
+                                  "WHERE key = ? AND revision > ?", (key, since)).fetchone()
+
+
+def is_leader():
+    """
+    Returns whether this worker should run the cluster's background jobs.
+    Always True outside of a cluster
+    """
+    return not cluster_enabled() or time.time() < leader_until
+
+
+def renew_lease():
+    """
+    Take or extend the leader lease for [cluster] lease_duration seconds.
+    The lease can only be taken once the previous holder let it expire.
+    """
+    global leader_until
+
+    now = time.time()
+    expires_at = now + get_config("cluster", "lease_duration", 30)
     try:
-        room_specific_data[room_id].pop(setting_key, None)
-    except:
-        log_warn("Tried to delete room key '%s' that did not exist on room '%s'." % (
-        setting_key, room_id))
+        with cluster_db_lock, cluster_db:
+            held = cluster_db.execute(
+                "INSERT INTO leases (name, holder, expires_at) VALUES ('leader', ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, "
+                "expires_at = excluded.expires_at "
+                "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                (worker_id, expires_at, now)).rowcount == 1
+    except sqlite3.Error:
+        # Keep leading until the lease we have runs out
+        log_warn("Unable to renew leader lease")
         return
 
-    # Backup old room data if available
-    data_filepath = config["bot"]["data_filepath"]
-    if os.path.exists(data_filepath):
-        os.rename(data_filepath, data_filepath + ".bak")
+    leader_until = expires_at if held else 0
+    set_gauge("mscbot_cluster_leader", {}, 1 if held else 0)
+
 
-    # Save updated data to disk
+def release_lease():
+    """Give up the leader lease, if this worker holds it"""
+    global leader_until
+
+    if leader_until == 0:
+        return
+
+    leader_until = 0
     try:
-        with open(data_filepath, 'w') as f:
-            json.dump(room_specific_data, f)
-    except:
-        log_warn("Unable to save room data to disk")
+        with cluster_db_lock, cluster_db:
+            cluster_db.execute("DELETE FROM leases WHERE name = 'leader' AND holder = ?",
+                               (worker_id,))
+    except sqlite3.Error:
+        log_warn("Unable to release leader lease")
 
 
-def invite_received(room_id, state):
-    """Matrix room invite received. Join the room"""
-    global client
-    time.sleep(3)  # Workaround for Synapse#2807
+def claim(name):
+    """
+    Claim a piece of work, such as handling a Matrix event, for this worker.
+    Returns whether no other worker of the cluster claimed it first. Always
+    True outside of a cluster
+    """
+    if not cluster_enabled():
+        return True
+
     try:
-        log_info("Joining room:", room_id)
-        client.join_room(room_id)
-    except:
-        log_warn("Unable to join room:", room_id)
-        log_warn("Trying again...")
-        time.sleep(5)
-        invite_received(room_id, state)
+        with cluster_db_lock, cluster_db:
+            return cluster_db.execute(
+                "INSERT OR IGNORE INTO claims (name, worker, claimed_at) VALUES (?, ?, ?)",
+                (name, worker_id, time.time())).rowcount == 1
+    except sqlite3.Error:
+        # Doing the work twice beats not doing it at all
+        log_warn("Unable to claim %s" % name)
+        return True
 
 
-def match_command(command):
-    """Returns a command ID on match, or None if no match"""
-    for key, command_list in known_commands.items():
-        for com in command_list:
-            if command.startswith(com):
-                return key
-    return None
+def prune_claims():
+    """Forget claims older than [cluster] claim_ttl seconds"""
+    cutoff = time.time() - get_config("cluster", "claim_ttl", 24 * 60 * 60)
+    with cluster_db_lock, cluster_db:
+        cluster_db.execute("DELETE FROM claims WHERE claimed_at < ?", (cutoff,))
 
 
-def process_args(room_id, command, mscs, handler, command_id):
+def sync_room_data():
     """
-    Pre-process command text to only retrieve command arguments and pass them
-    to handler function
+    Load room settings other workers changed from the shared store. Returns
+    the IDs of the rooms whose settings changed
     """
+    shared = store_get("room_settings", cluster_revisions.get("room_settings", 0))
+    if shared is None:
+        return []
+
+    changed = []
+    with room_data_lock:
+        for room_id, settings in room_data_db.execute(
+                "SELECT room_id, settings FROM room_settings").fetchall():
+            # Local changes that haven't been saved yet win
+            if room_id in dirty_rooms:
+                continue
+            settings = json.loads(settings)
+            if room_specific_data.get(room_id) != settings:
+                room_specific_data[room_id] = settings
+                changed.append(room_id)
+        cluster_revisions["room_settings"] = shared[0]
+    return changed
 
-    # Figure out which varation of the command was used
-    longest_match_length = 0
-    for variation in known_commands[command_id]:
-        if command.startswith(variation):
-            longest_match_length = len(variation)
 
-    # Get just the arguments by removing the longest match command
-    arguments = command[longest_match_length:].split()
+async def sync_cluster_forever():
+    """
+    Every [cluster] sync_interval seconds, pick up room settings other
+    workers changed and renew the leader lease. The worker that becomes
+    leader takes over the daily summary schedule.
+    """
+    interval = get_config("cluster", "sync_interval", 5)
+    last_pruned = 0
+    while True:
+        try:
+            for room_id in await loop.run_in_executor(None, sync_room_data):
+                # Rooms may have moved to another summary time
+                add_to_summary_bucket(room_id, get_summary_time(room_id))
+                scheduler_wakeup.set()
+
+            was_leader = is_leader()
+            await loop.run_in_executor(None, renew_lease)
+            if is_leader() and not was_leader:
+                log_info("Worker", worker_id, "is now the cluster leader")
+                # Send summaries that fell due while there was no leader
+                restore_summary_schedule()
+                scheduler_wakeup.set()
+            elif was_leader and not is_leader():
+                log_warn("Worker %s lost the cluster leader lease" % worker_id, trace=False)
+
+            if is_leader() and time.time() - last_pruned > 60 * 60:
+                await loop.run_in_executor(None, prune_claims)
+                last_pruned = time.time()
+        except Exception:
+            log_warn("Unable to sync with the cluster")
+
+        await asyncio.sleep(interval)
+
+
+def invite_received(room_id, state):
+    """Matrix room invite received. Join the room in the background"""
+    loop.call_soon_threadsafe(queue_join, room_id)
+
+
+def queue_join(room_id):
+    """
+    Start joining a room, unless it is already being joined. Must be called
+    from the event loop.
+    """
+    if room_id in pending_joins:
+        log_info("Already joining room:", room_id)
+        return
+
+    pending_joins.add(room_id)
+    loop.create_task(join_room(room_id))
+
+
+async def join_room(room_id):
+    """
+    Join a room, retrying failures with exponential backoff capped at
+    [matrix] join_max_backoff seconds, for up to [matrix] join_attempts
+    attempts
+    """
+    max_attempts = get_config("matrix", "join_attempts", 8)
+    max_backoff = get_config("matrix", "join_max_backoff", 300)
+
+    await asyncio.sleep(3)  # Workaround for Synapse#2807
+    try:
+        for attempt in range(1, max_attempts + 1):
+            try:
+                log_info("Joining room:", room_id)
+                with track_request("matrix_join"):
+                    await loop.run_in_executor(None, client.join_room, room_id)
+                log_info("Joined room:", room_id)
+                return
+            except Exception as e:
+                log_warn("Unable to join room %s: %s" % (room_id, e))
+
+            if attempt < max_attempts:
+                delay = min(5 * 2 ** (attempt - 1), max_backoff)
+                log_warn("Trying again in %ds..." % delay, trace=False)
+                await asyncio.sleep(delay)
+
+        log_warn("Giving up joining room %s after %d attempts" % (room_id, max_attempts), trace=False)
+    finally:
+        pending_joins.discard(room_id)
+
 
-    # Clean up any spaces
-    arguments = [arg.strip() for arg in arguments]
+def match_command(command):
+    """
+    Returns a tuple of the command ID and its list of arguments on match, or
+    (None, None) if no match
+    """
+    match = command_regex.match(command)
+    if match is None:
+        return None, None
 
-    return handler(room_id, arguments, mscs)
+    # Get just the arguments by removing the longest match command
+    arguments = command[match.end():].split()
+    return command_variants[match.group(0)], arguments
 
 
 def event_received(event):
-    """Matrix event received. Act if it was directed at us"""
+    """
+    Matrix event received. If it was directed at us, queue it up to be handled
+    by the room's worker. Called from the sync thread.
+    """
     global client
-    if event["content"]["msgtype"] != "m.text":
+    if event["content"].get("msgtype") != "m.text":
         return
 
     body = event["content"]["body"].strip()
-    room = client.get_rooms()[event["room_id"]]
-    room_id = room.room_id
     username = config["bot"]["command"]
     if body.startswith(username + ":"):
-        command = body[8:].strip()
-        log_info("Received command:", command)
-        command_id = match_command(command)
-        if command_id is None:
-            room.send_html("Unknown command.", msgtype=config["matrix"]["message_type"])
+        # Every worker of a cluster receives the event. Only one answers
+        if not claim("event " + event["event_id"]):
             return
 
-        # Retrieve MSC information from Github labels
-        mscs = get_mscs(room_id)
-
-        if command_id == "SHOW_IN_PROGRESS":
-            response = reply_in_progress_mscs(mscs)
-        elif command_id == "SHOW_PENDING":
-            response = reply_pending_mscs(mscs)
-        elif command_id == "SHOW_FCP":
-            response = reply_fcp_mscs(mscs)
-        elif command_id == "SHOW_ALL":
-            response = reply_all_mscs(mscs)
-        elif command_id == "SHOW_NEWS":
-            response = process_args(room_id, command, mscs, reply_news, "SHOW_NEWS")
-        elif command_id == "SHOW_TASKS":
-            response = process_args(room_id, command, mscs, reply_tasks, "SHOW_TASKS")
-        elif command_id == "HELP":
-            response = show_help(room_id)
-        elif command_id == "ROOM_SUMMARY_CONTENT":
-            response = process_args(room_id, command, mscs, room_summary_content,
-                                    "ROOM_SUMMARY_CONTENT")
-        elif command_id == "ROOM_SUMMARY_ENABLE":
-            response = process_args(room_id, command, mscs, room_summary_enable,
-                                    "ROOM_SUMMARY_ENABLE")
-        elif command_id == "ROOM_SUMMARY_DISABLE":
-            response = process_args(room_id, command, mscs, room_summary_disable,
-                                    "ROOM_SUMMARY_DISABLE")
-
-        elif command_id == "ROOM_SUMMARY_WEEKEND_ENABLE":
-            response = process_args(room_id, command, mscs, room_summary_weekend_enable,
-                                    "ROOM_SUMMARY_WEEKEND_ENABLE")
-        elif command_id == "ROOM_SUMMARY_WEEKEND_DISABLE":
-            response = process_args(room_id, command, mscs, room_summary_weekend_disable,
-                                    "ROOM_SUMMARY_WEEKEND_DISABLE")
-        elif command_id == "ROOM_SUMMARY_TIME":
-            response = process_args(room_id, command, mscs, room_summary_time,
-                                    "ROOM_SUMMARY_TIME")
-        elif command_id == "ROOM_SUMMARY_TIME_INFO":
-            response = process_args(room_id, command, mscs, room_summary_time_info,
-                                    "ROOM_SUMMARY_TIME_INFO")
-        elif command_id == "ROOM_SHOW_PRIORITY":
-            response = process_args(room_id, command, mscs, room_show_priority,
-                                    "ROOM_SHOW_PRIORITY")
-        elif command_id == "ROOM_PRIORITY_MSCS":
-            response = process_args(room_id, command, mscs, room_priority_mscs,
-                                    "ROOM_PRIORITY_MSCS")
-        elif command_id == "SHOW_SUMMARY":
-            send_summary(room_id)
-            return  # send_summary sends its own message
+        command = body[len(username) + 1:].strip()
+        log_info("Received command:", command)
+        loop.call_soon_threadsafe(queue_room_task, event["room_id"], handle_command,
+                                  event["room_id"], command)
+
+
+def queue_room_task(room_id, func, *args):
+    """
+    Queue a blocking task for a room. Tasks for the same room are run one at
+    a time in the order they were queued, while tasks for different rooms
+    run concurrently. Must be called from the event loop.
+    """
+    global room_queues
+
+    queue = room_queues.get(room_id)
+    if queue is None:
+        queue = room_queues[room_id] = deque()
+        loop.create_task(room_worker(room_id, queue))
+    queue.append((func, args))
 
+
+async def room_worker(room_id, queue):
+    """Runs the queued tasks of a room until there are none left"""
+    global room_queues
+
+    while len(queue) > 0:
+        func, args = queue.popleft()
         try:
-            # Send the response
-            log_info("Sending command response to %s" % room_id)
-            room.send_html(markdown(response), body=response, msgtype=config["matrix"]["message_type"])
-            log_info("Sent to %s" % room_id)
-        except:
-            log_warn("Unable to post to room")
+            await loop.run_in_executor(command_pool, func, *args)
+        except Exception:
+            log_warn("Error while running task for room %s" % room_id)
+
+    del room_queues[room_id]
+
+
+def handle_command(room_id, command):
+    """Act on a command sent to a room. Runs in the command thread pool"""
+    command_id, arguments = match_command(command)
+    if command_id is None:
+        send_message(room_id, "Unknown command.")
+        return
+
+    start = time.perf_counter()
+    try:
+        with github_priority("command"):
+            run_command(room_id, command_id, arguments)
+    finally:
+        observe("mscbot_command_seconds", {"command": command_id}, time.perf_counter() - start)
+
+
+def run_command(room_id, command_id, arguments):
+    """Runs the handler of a command and sends its response"""
+    command = command_handlers[command_id]
+    handler = command["handler"]
+    html = None
+
+    snapshot = None
+    if "snapshot" not in command["needs"]:
+        # Nothing to download
+        response = handler(room_id, arguments, None)
+    else:
+        # Retrieve MSC information from Github labels
+        snapshot = get_snapshot()
+        priority_mscs = tuple(get_room_setting(room_id, "priority_mscs") or ())
+        mscs = filter_priority_mscs(snapshot, priority_mscs)
+
+        if command["cached"]:
+            response, html = render_cached(snapshot, command_id,
+                                           (priority_mscs, tuple(arguments)),
+                                           lambda: handler(room_id, arguments, mscs))
+        else:
+            response = handler(room_id, arguments, mscs)
+
+    if response is None:
+        return  # The handler sent its own message
+
+    if snapshot is not None:
+        response, html = add_staleness_note(snapshot, response, html)
+
+    # Send the response
+    send_message(room_id, response, html)
+
+
+def staleness_note(snapshot):
+    """
+    Returns a markdown note saying how old an MSC snapshot is if it could not
+    be kept up to date with Github, otherwise None
+    """
+    if not snapshot.get("stale"):
+        return None
+
+    synced_at = datetime.fromtimestamp(snapshot["synced_at"], timezone.utc)
+    if snapshot["stale"] == "rate_limited":
+        reason = "Github's rate limit is running low"
+        resource = "graphql" if get_config("github", "backend", "rest") == "graphql" else "core"
+        budget = github_budget.get(resource)
+        if budget is not None and budget["reset"] > time.time():
+            reason += " until %s UTC" % datetime.fromtimestamp(
+                budget["reset"], timezone.utc).strftime("%H:%M")
+    elif snapshot["stale"] == "restarted":
+        reason = "the bot has just restarted and is catching up"
+    else:
+        reason = "Github could not be reached"
+
+    return "_MSC information as of %s UTC, as %s._" % (
+        synced_at.strftime("%Y-%m-%d %H:%M"), reason)
+
+
+def add_staleness_note(snapshot, body, html):
+    """
+    Adds the staleness note of a snapshot, if any, to a (plain body, HTML
+    body) pair. The HTML body may be None
+    """
+    note = staleness_note(snapshot)
+    if note is None:
+        return body, html
+
+    body += "\n\n" + note
+    if html is not None:
+        html += markdown(note)
+    return body, html
+
+
+def render_cached(snapshot, view, params, render):
+    """
+    Returns a (plain body, HTML body) pair for a view of a snapshot. render()
+    is only called to produce the plain body if the view has not been
+    rendered for this snapshot version and tuple of filter params yet today.
+    """
+    global render_cache
+
+    # Remaining FCP days change at UTC midnight even if the snapshot doesn't.
+    # See reply_fcp_mscs()
+    key = (snapshot["version"], view, params, utc_naive(datetime.now(timezone.utc)).date())
+    with render_cache_lock:
+        count_cache_lookup("rendered_responses", key in render_cache)
+        if key in render_cache:
+            render_cache.move_to_end(key)
+            return render_cache[key]
+
+    body = render()
+    rendered = (body, markdown(body))
 
+    with render_cache_lock:
+        render_cache[key] = rendered
+        while len(render_cache) > get_config("cache", "rendered_responses", 128):
+            render_cache.popitem(last=False)
 
-def show_help(room_id):
+    return rendered
+
+
+@command_handler("HELP")
+def show_help(room_id, arguments, mscs):
     """Return help text"""
     global config
 
@@ -326,6 +1135,16 @@ Show MSC tasks that must still be completed:
 <pre><code>show tasks [github username]
 </code></pre>
 
+Search the titles, bodies and labels of open MSCs:
+
+<pre><code>search (terms)
+</code></pre>
+
+Show how long MSCs spend in each stage, how many move through each stage per month, and how long open MSCs have been in their current stage:
+
+<pre><code>show stats [months]
+</code></pre>
+
 **Per-room Bot Options**
 
 Set priority MSCs. If set, only information about these MSCs will be shown:
@@ -348,6 +1167,11 @@ Enable/disable daily summary:
 <pre><code>set summary enable|disable
 </code></pre>
 
+Enable/disable daily summary on weekends (enabled by default):
+
+<pre><code>set summary weekend enable|disable
+</code></pre>
+
 Set daily summary time:
 
 <pre><code>set summary time 08:00|8am|8:15pm|etc.
@@ -392,6 +1216,7 @@ Show this help:
 
 
 # Room Specific Commands
+@command_handler("ROOM_PRIORITY_MSCS")
 def room_priority_mscs(room_id, arguments, mscs):
     """Room-specific option to filter output by specific MSC numbers"""
     if len(arguments) == 0:
@@ -419,6 +1244,7 @@ def room_priority_mscs(room_id, arguments, mscs):
     return "Priority MSCs set: %s" % str(numbers)
 
 
+@command_handler("ROOM_SHOW_PRIORITY")
 def room_show_priority(room_id, arguments, mscs):
     """Show the currently-set priority MSCs for a room"""
     global config
@@ -437,6 +1263,7 @@ def room_show_priority(room_id, arguments, mscs):
     return "Currently set priority MSCs: %s" % response
 
 
+@command_handler("ROOM_SUMMARY_CONTENT")
 def room_summary_content(room_id, arguments, mscs):
     """Room-specific option for daily summary contents"""
 
@@ -452,30 +1279,36 @@ Usage: `set summary content: [all, pending, fcp, in-progress]`""")
     return "Summary content updated successfully to '%s'." % arguments[0]
 
 
+@command_handler("ROOM_SUMMARY_ENABLE")
 def room_summary_enable(room_id, arguments, mscs):
     """Enable daily summary for this room"""
     update_room_setting(room_id, {"summary_enabled": True})
+    loop.call_soon_threadsafe(schedule_summary, room_id)
     return "Daily summary enabled."
 
 
+@command_handler("ROOM_SUMMARY_DISABLE")
 def room_summary_disable(room_id, arguments, mscs):
     """Disable daily summary for this room"""
     update_room_setting(room_id, {"summary_enabled": False})
     return "Daily summary disabled."
 
 
+@command_handler("ROOM_SUMMARY_WEEKEND_ENABLE")
 def room_summary_weekend_enable(room_id, arguments, mscs):
     """Enable daily summary on weekends for this room"""
     update_room_setting(room_id, {"summary_weekend_enabled": True})
     return "Daily summary enabled on the weekends."
 
 
+@command_handler("ROOM_SUMMARY_WEEKEND_DISABLE")
 def room_summary_weekend_disable(room_id, arguments, mscs):
     """Disable daily summary on weekends for this room"""
     update_room_setting(room_id, {"summary_weekend_enabled": False})
     return "Daily summary disabled on the weekends."
 
 
+@command_handler("ROOM_SUMMARY_TIME_INFO")
 def room_summary_time_info(room_id, arguments, mscs):
     """Show current summary time configured for this room"""
     global room_specific_data
@@ -489,12 +1322,13 @@ def room_summary_time_info(room_id, arguments, mscs):
         response += config["bot"]["daily_summary_time"]
     response += " UTC."
 
-    if not get_room_setting(room_id, "summary_enabled"):
+    if not summary_enabled(room_id):
         response += " However, summaries in this room are currently disabled."
 
     return response
 
 
+@command_handler("ROOM_SUMMARY_TIME")
 def room_summary_time(room_id, arguments, mscs):
     """Set the daily time for the room summary"""
     if len(arguments) == 0:
@@ -518,17 +1352,14 @@ Usage: `set summary time 07:00` or `set summary time 4pm`""")
         else:
             min = "%d" % time.tm_min
 
-        # Convert to 24hr time to hand off to schedule lib
+        # Convert to 24hr time to hand off to the scheduler
         time_24hr = "%s:%s" % (hour, min)
 
         # Update time in room settings
         update_room_setting(room_id, {"summary_time": time_24hr})
 
-        # Cancel old time scheduler
-        schedule.clear(room_id)
-
-        # Add scheduler for new time
-        schedule.every().day.at(time_24hr).do(send_summary, room_id).tag(room_id)
+        # Move the room to its new time on the event loop
+        loop.call_soon_threadsafe(schedule_summary, room_id)
 
         # Get the current time for reference
         curr_time = datetime.now().strftime("%H:%M")
@@ -540,122 +1371,469 @@ Usage: `set summary time 07:00` or `set summary time 4pm`""")
         return "Unknown time parameter '%s'." % arguments[0]
 
 
-def set_up_default_summaries():
-    """Sets up a scheduler for a daily summary for all rooms that do not have a schedule set"""
-    global client
-    global room_specific_data
+def summary_enabled(room_id):
+    """
+    Returns whether daily summaries are enabled for a room. Rooms that never
+    enabled or disabled them only get them if they set a summary time.
+    """
+    enabled = get_room_setting(room_id, "summary_enabled")
+    if enabled is None:
+        return bool(get_room_setting(room_id, "summary_time"))
+    return enabled
 
-    for room_id in room_specific_data.keys():
-        if get_room_setting(room_id, "summary_time"):
-            continue
-        if not get_room_setting(room_id, "summary_enabled"):
-            continue
-        if get_room_setting(room_id, "summary_weekend_enabled", True):  # On by default
-            if currently_weekend():
-                continue
 
-        # Schedule a summary
-        schedule.every().day.at(config["bot"]["daily_summary_time"]).do(send_summary,
-                                                                        room_id).tag(room_id)
+def get_summary_time(room_id):
+    """Returns the daily summary time of a room"""
+    return get_room_setting(room_id, "summary_time") or config["bot"]["daily_summary_time"]
 
-def currently_weekend():
-    """Returns true or false based on whether it is currently the weekend"""
-    return datetime.today().weekday() >= 5
 
-def send_summary(room_id):
+def next_summary_fire_time(summary_time, after):
     """
-    Sends a daily summary of MSCs to the specified room.
-    Returns False if summaries are not enabled for this room, otherwise True
+    Returns the first time, as a unix timestamp, after the given unix
+    timestamp that a daily summary at summary_time ("HH:MM" UTC) is due
     """
-    global config
+    hour, minute = [int(part) for part in summary_time.split(":")]
+    after_date = datetime.fromtimestamp(after, timezone.utc)
+    fire_date = after_date.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if fire_date <= after_date:
+        fire_date += timedelta(days=1)
+    return fire_date.timestamp()
 
-    # Get MSC metadata from Github labels
-    mscs = get_mscs(room_id)
 
-    # See which summary mode this room wants
-    mode = get_room_setting(room_id, "summary_content")
-    if mode == "in-progress":
-        info = reply_in_progress_mscs(mscs)
-    elif mode == "pending":
-        info = reply_pending_mscs(mscs)
-    elif mode == "fcp":
-        info = reply_fcp_mscs(mscs)
-    elif mode == "all" or mode == None:  # Default to mode 'all'
-        info = reply_all_mscs(mscs)
-    else:
-        log_warn("Unknown summary mode for room %s: %s" % (room_id, mode), trace=False)
+def add_to_summary_bucket(room_id, summary_time):
+    """Moves a room to the bucket of rooms with a daily summary at summary_time"""
+    old_time = summary_room_times.get(room_id)
+    if old_time is not None:
+        summary_buckets[old_time].discard(room_id)
 
-    # Print MSC goal progress if a goal is set
-    # TODO: Place in title/Erik's weird Riot header thingy
-    priority_mscs = get_room_setting(room_id, "priority_mscs")
-    if priority_mscs:
-        goal = len(priority_mscs)
-        completed_mscs = 0
+    if summary_time not in summary_buckets:
+        summary_buckets[summary_time] = set()
+        heapq.heappush(summary_heap,
+                       (next_summary_fire_time(summary_time, time.time()), summary_time))
 
-        for msc in mscs:
-            # Skip non-priority MSCs
-            if msc["issue"].number not in priority_mscs:
-                continue
+    summary_buckets[summary_time].add(room_id)
+    summary_room_times[room_id] = summary_time
 
-            # Check if this MSC has passed final comment period
-            if ((msc_labels["proposal-in-review"] not in msc["labels"] and
-                 msc_labels["proposed-final-comment-period"] not in msc["labels"] and
-                 msc_labels["final-comment-period"] not in msc["labels"]) or
-                    "finished-final-comment-period" in msc["labels"]):
-                completed_mscs += 1
 
-        info += "\n\nPriority MSC progress: %d/%d" % (completed_mscs, goal)
+def schedule_summary(room_id):
+    """
+    Schedule the daily summary of a room at its configured time, replacing
+    any existing one. Must be called from the event loop.
+    """
+    add_to_summary_bucket(room_id, get_summary_time(room_id))
+    update_room_setting(room_id, {"summary_next_fire": next_summary_fire_time(
+        get_summary_time(room_id), time.time())})
 
-    # Send summary
-    try:
-        room = client.get_rooms()[room_id]
-        room.send_html(
-            markdown(info), body=info, msgtype=config["matrix"]["message_type"]
-        )
-    except Exception as e:
-        log_warn("Unable to send daily summary to %s: %s", room_id, e)
+    # The next summary may be due sooner than the scheduler expects
+    if scheduler_wakeup:
+        scheduler_wakeup.set()
 
-    return True
 
+def restore_summary_schedule():
+    """
+    Schedule daily summaries for all known rooms. Summaries that were due
+    while the bot was not running, no longer than [bot] summary_catch_up
+    seconds ago, are sent straight away.
 
-def reply_in_progress_mscs(mscs):
-    """Returns a formatted reply with MSCs that are proposed but not yet pending an FCP"""
-    in_progress = []
-    for msc_dict in mscs:
-        msc = msc_dict["issue"]
-        labels = msc_dict["labels"]
-        if msc_labels["proposal-in-review"] in labels:
-            in_progress.append("[%s](%s)" % (msc.title, msc.html_url))
+    In a cluster, only the leader sends summaries. Other workers keep track
+    of the schedule so they can take over, and catch up when they do.
+    """
+    now = time.time()
+    catch_up = get_config("bot", "summary_catch_up", 6 * 60 * 60)
 
-    response = "\n\n**In Progress**\n\n"
-    if len(in_progress) > 0:
-        response += '\n\n'.join(in_progress)
-    else:
-        response += "\n\nNo in-progress MSCs."
+    with room_data_lock:
+        room_ids = list(room_specific_data.keys())
 
-    return response
+    for room_id in room_ids:
+        add_to_summary_bucket(room_id, get_summary_time(room_id))
+        if not is_leader():
+            continue
 
+        missed = get_room_setting(room_id, "summary_next_fire")
+        if missed and now - catch_up <= missed < now and summary_due(room_id, missed):
+            log_info("Catching up on missed daily summary for", room_id)
+            queue_summary(room_id, missed)
 
-def reply_pending_mscs(mscs, user=None):
-    """Returns a formatted reply with MSCs that are currently pending a FCP"""
-    pending = []
-    for msc_dict in mscs:
-        msc = msc_dict["issue"]
-        labels = msc_dict["labels"]
-        fcp = msc_dict["fcp"]
-        if msc_labels["proposed-final-comment-period"] in labels and fcp != None:
-            # Show proposed FCPs and team members who have yet to agree
-            # If a specific github user was specified, filter by FCPs that that
-            # user needs to review
-            # TODO: Show concern count
-            reviewers = [x[0]["login"] for x in fcp["reviews"] if x[1] is False]
-            if user and user not in reviewers:
-                continue
+        if missed is None or missed < now:
+            update_room_setting(room_id, {"summary_next_fire": next_summary_fire_time(
+                get_summary_time(room_id), now)})
 
-            # Attempt to convert each reviewer's github username to a Matrix ID
-            if "user_ids" in config:
-                temp_reviewers = []
-                for github_username in reviewers:
+
+def summary_due(room_id, fire_time):
+    """
+    Returns whether a room should get the daily summary that fell due at
+    fire_time, a unix timestamp
+    """
+    if not summary_enabled(room_id):
+        return False
+
+    # Summaries are sent on weekends unless disabled for them
+    weekend = datetime.fromtimestamp(fire_time, timezone.utc).weekday() >= 5
+    if weekend and get_room_setting(room_id, "summary_weekend_enabled") == False:
+        return False
+
+    return True
+
+
+def run_due_summaries():
+    """
+    Queue the daily summaries of every bucket of rooms that is due. Only
+    buckets that are due are looked at, however many rooms there are. In a
+    cluster, only the leader queues them.
+    """
+    now = time.time()
+    while len(summary_heap) > 0 and summary_heap[0][0] <= now:
+        fire_time, summary_time = heapq.heappop(summary_heap)
+        room_ids = summary_buckets[summary_time]
+        if len(room_ids) == 0:
+            # Every room moved away from this time
+            del summary_buckets[summary_time]
+            continue
+
+        next_fire_time = next_summary_fire_time(summary_time, max(fire_time, now))
+        heapq.heappush(summary_heap, (next_fire_time, summary_time))
+        if not is_leader():
+            continue
+
+        for room_id in room_ids:
+            if summary_due(room_id, fire_time):
+                queue_summary(room_id, fire_time)
+            update_room_setting(room_id, {"summary_next_fire": next_fire_time})
+
+
+def seconds_until_next_job():
+    """
+    Returns the number of seconds until the next scheduled job is due, or
+    None if there are no scheduled jobs
+    """
+    if len(summary_heap) == 0:
+        return None
+    return max(summary_heap[0][0] - time.time(), 0)
+
+
+def queue_summary(room_id, fire_time):
+    """
+    Add a room to the next batch of daily summaries. fire_time is when the
+    summary fell due, as a unix timestamp. Summaries that fall due within
+    [bot] summary_batch_window seconds of each other are sent as one batch.
+    Must be called from the event loop.
+    """
+    if len(pending_summaries) == 0:
+        loop.call_later(get_config("bot", "summary_batch_window", 5), send_pending_summaries)
+    pending_summaries.setdefault(room_id, fire_time)
+
+
+def send_pending_summaries():
+    """Send the current batch of daily summaries. Called from the event loop"""
+    fire_times = dict(pending_summaries)
+    pending_summaries.clear()
+    future = loop.run_in_executor(command_pool, send_summary_batch, sorted(fire_times), fire_times)
+    future.add_done_callback(log_background_error)
+
+
+def send_summary_batch(room_ids, fire_times=None):
+    """
+    Sends daily summaries to a batch of rooms. All rooms share one snapshot,
+    and each distinct combination of summary content and priority MSCs is
+    only rendered once. fire_times maps room IDs to when their summary fell
+    due, for measuring delivery lag.
+    """
+    with github_priority("summary"):
+        try:
+            snapshot = get_snapshot()
+        except:
+            log_warn("Unable to retrieve MSCs for daily summaries")
+            return
+
+        for room_id in room_ids:
+            # A worker that just lost the leader lease may have sent it already
+            fire_time = (fire_times or {}).get(room_id)
+            if fire_time is not None and not claim("summary %s %d" % (room_id, fire_time)):
+                continue
+
+            body, html = add_staleness_note(snapshot, *render_room_summary(snapshot, room_id))
+            log_info("Sending daily summary to", room_id)
+
+            # Send behind any commands the room is waiting on
+            loop.call_soon_threadsafe(queue_room_task, room_id, send_message, room_id, body,
+                                      html, "summary", fire_time)
+
+
+def send_summary(room_id):
+    """
+    Sends a daily summary of MSCs to the specified room.
+    Returns False if summaries are not enabled for this room, otherwise True
+    """
+    # Get MSC metadata from Github labels
+    snapshot = get_snapshot()
+    body, html = add_staleness_note(snapshot, *render_room_summary(snapshot, room_id))
+
+    # Send summary, replacing any that is still waiting to be sent
+    send_message(room_id, body, html, supersedes="summary")
+    return True
+
+
+def render_room_summary(snapshot, room_id):
+    """
+    Returns the (plain body, HTML body) daily summary for a room. Rooms with
+    the same summary content and priority MSCs share a rendered summary.
+    """
+    mode = get_room_setting(room_id, "summary_content")
+    priority_mscs = tuple(get_room_setting(room_id, "priority_mscs") or ())
+    return render_cached(
+        snapshot, "summary", (mode, priority_mscs),
+        lambda: render_summary(filter_priority_mscs(snapshot, priority_mscs),
+                               mode, priority_mscs))
+
+
+def render_summary(mscs, mode, priority_mscs):
+    """
+    Returns a daily summary of the given MSCs with the given summary content
+    mode, and the progress made on priority MSCs if any are set
+    """
+    # See which summary mode this room wants
+    if mode == "in-progress":
+        info = reply_in_progress_mscs(mscs)
+    elif mode == "pending":
+        info = reply_pending_mscs(mscs)
+    elif mode == "fcp":
+        info = reply_fcp_mscs(mscs)
+    else:
+        if mode != "all" and mode != None:
+            log_warn("Unknown summary mode: %s" % mode, trace=False)
+        info = reply_all_mscs(mscs)  # Default to mode 'all'
+
+    # Print MSC goal progress if a goal is set
+    # TODO: Place in title/Erik's weird Riot header thingy
+    if priority_mscs:
+        goal = len(priority_mscs)
+
+        # MSCs that have passed final comment period. mscs only holds
+        # priority MSCs
+        completed_mscs = len(mscs["buckets"]["finished"])
+
+        info += "\n\nPriority MSC progress: %d/%d" % (completed_mscs, goal)
+
+    return info
+
+
+def send_message(room_id, text, html=None, supersedes=None, due_at=None):
+    """
+    Queues a markdown-formatted message to be sent to a room. html is the
+    already rendered message, if available. A message with a supersedes key
+    replaces any message with the same key still waiting to be sent to the
+    room. due_at is when a daily summary fell due, as a unix timestamp.
+    Can be called from any thread.
+    """
+    if html is None:
+        html = markdown(text)
+
+    message = {"text": text, "html": html, "supersedes": supersedes,
+               "txn_id": "mscbot.%s.%d" % (worker_id, next(outbound_txn_ids)),
+               "queued_at": time.time(), "due_at": due_at}
+    loop.call_soon_threadsafe(queue_message, room_id, message)
+
+
+def queue_message(room_id, message):
+    """
+    Add a message to the outbound queue of a room. Messages to the same room
+    are delivered one at a time in the order they were queued. Must be
+    called from the event loop.
+    """
+    global outbound_queues
+
+    queue = outbound_queues.get(room_id)
+    if queue is None:
+        queue = outbound_queues[room_id] = deque()
+        loop.create_task(deliver_messages(room_id, queue))
+
+    if message["supersedes"] is not None:
+        superseded = [queued for queued in queue
+                      if queued["supersedes"] == message["supersedes"]]
+        for queued in superseded:
+            queue.remove(queued)
+        outbound_stats["superseded"] += len(superseded)
+
+    queue.append(message)
+
+
+async def deliver_messages(room_id, queue):
+    """
+    Sends the queued messages of a room until there are none left. At most
+    [matrix] send_concurrency rooms are sent to at once. Rate limited
+    messages are retried after the delay the homeserver asks for, and other
+    failures are retried with exponential backoff up to [matrix] send_retries
+    times before the message is dropped.
+    """
+    global outbound_queues
+    global outbound_backoff_until
+
+    while len(queue) > 0:
+        message = queue.popleft()
+        failures = 0
+
+        while True:
+            # Rate limits apply to the whole account, so every room waits
+            delay = outbound_backoff_until - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            async with outbound_slots:
+                try:
+                    r = await loop.run_in_executor(None, put_message, room_id, message)
+                except Exception as e:
+                    r = None
+                    error = e
+
+            if r is not None and r.status_code == 200:
+                record_delivery(room_id, message)
+                break
+
+            if r is not None and r.status_code == 429:
+                try:
+                    retry_after = r.json()["retry_after_ms"] / 1000
+                except Exception:
+                    retry_after = 5
+                log_warn("Rate limited by homeserver, retrying in %.1fs" % retry_after, trace=False)
+                outbound_stats["rate_limited"] += 1
+                outbound_backoff_until = max(outbound_backoff_until, time.time() + retry_after)
+                continue
+
+            if r is not None:
+                error = "%d %s" % (r.status_code, r.text)
+            failures += 1
+            if (r is not None and r.status_code < 500) or \
+                    failures > get_config("matrix", "send_retries", 5):
+                log_warn("Unable to post to room %s: %s" % (room_id, error), trace=False)
+                outbound_stats["dropped"] += 1
+                break
+            await asyncio.sleep(min(2 ** failures, 60))
+
+    del outbound_queues[room_id]
+
+
+def put_message(room_id, message):
+    """Sends a queued message to a room. Returns the homeserver's response"""
+    global outbound_session
+
+    if outbound_session is None:
+        outbound_session = requests.Session()
+
+    # Resending with the same transaction ID can never post a message twice
+    url = "%s/_matrix/client/r0/rooms/%s/send/m.room.message/%s" % (
+        homeserver, quote(room_id, safe=""), quote(message["txn_id"], safe=""))
+    content = {"msgtype": config["matrix"]["message_type"],
+               "body": message["text"],
+               "format": "org.matrix.custom.html",
+               "formatted_body": message["html"]}
+
+    log_info("Sending message to %s" % room_id)
+    with track_request("matrix_send"):
+        return outbound_session.put(url, json=content, timeout=30, headers={
+            "Authorization": "Bearer " + config["matrix"]["token"]})
+
+
+def record_delivery(room_id, message):
+    """Update delivery statistics for a sent message"""
+    latency = time.time() - message["queued_at"]
+    outbound_stats["sent"] += 1
+    outbound_stats["latency_total"] += latency
+    outbound_stats["latency_max"] = max(outbound_stats["latency_max"], latency)
+    if message["due_at"] is not None:
+        observe("mscbot_summary_delivery_lag_seconds", {}, time.time() - message["due_at"])
+
+    log_info("Sent to %s after %.2fs, %d messages queued" %
+             (room_id, latency, outbound_status()["queued"]))
+
+
+def outbound_status():
+    """
+    Returns delivery statistics and the current depth of the outbound queues.
+    Must be called from the event loop
+    """
+    status = dict(outbound_stats)
+    status["queued"] = sum(len(queue) for queue in outbound_queues.values())
+    status["rooms_queued"] = len(outbound_queues)
+    # Each room's queue is oldest first
+    status["oldest_age"] = max([time.time() - queue[0]["queued_at"]
+                                for queue in outbound_queues.values() if len(queue) > 0],
+                               default=0)
+    if status["sent"] > 0:
+        status["latency_mean"] = status["latency_total"] / status["sent"]
+    return status
+
+
+async def get_outbound_status():
+    """outbound_status(), for other threads to run on the event loop"""
+    return outbound_status()
+
+
+@command_handler("SHOW_SUMMARY", needs=("snapshot",))
+def show_summary(room_id, arguments, mscs):
+    """Show the summary once for this room, whether it is enabled daily or not"""
+    send_summary(room_id)
+    return None  # send_summary sends its own message
+
+
+@command_handler("SHOW_IN_PROGRESS", needs=("snapshot",), cached=True)
+def show_in_progress(room_id, arguments, mscs):
+    """Show MSCs that are still being finalized"""
+    return reply_in_progress_mscs(mscs)
+
+
+@command_handler("SHOW_PENDING", needs=("snapshot",), cached=True)
+def show_pending(room_id, arguments, mscs):
+    """Show MSCs which are pending a FCP"""
+    return reply_pending_mscs(mscs)
+
+
+@command_handler("SHOW_FCP", needs=("snapshot",), cached=True)
+def show_fcp(room_id, arguments, mscs):
+    """Show MSCs that are currently in FCP"""
+    return reply_fcp_mscs(mscs)
+
+
+@command_handler("SHOW_ALL", needs=("snapshot",), cached=True)
+def show_all(room_id, arguments, mscs):
+    """Show MSCs that are in progress, pending or in FCP"""
+    return reply_all_mscs(mscs)
+
+
+def reply_in_progress_mscs(mscs):
+    """Returns a formatted reply with MSCs that are proposed but not yet pending an FCP"""
+    in_progress = []
+    for msc_dict in mscs["buckets"]["in-progress"]:
+        msc = msc_dict["issue"]
+        in_progress.append("[%s](%s)" % (msc.title, msc.html_url))
+
+    response = "\n\n**In Progress**\n\n"
+    if len(in_progress) > 0:
+        response += '\n\n'.join(in_progress)
+    else:
+        response += "\n\nNo in-progress MSCs."
+
+    return response
+
+
+def reply_pending_mscs(mscs, user=None):
+    """Returns a formatted reply with MSCs that are currently pending a FCP"""
+    pending = []
+    for msc_dict in mscs["buckets"]["pending-fcp"]:
+        msc = msc_dict["issue"]
+        fcp = msc_dict["fcp"]
+        if fcp != None:
+            # Show proposed FCPs and team members who have yet to agree
+            # If a specific github user was specified, filter by FCPs that that
+            # user needs to review
+            # TODO: Show concern count
+            reviewers = [review.login for review in fcp.reviews if review.approved is False]
+            if user and user not in reviewers:
+                continue
+
+            # Attempt to convert each reviewer's github username to a Matrix ID
+            if "user_ids" in config:
+                temp_reviewers = []
+                for github_username in reviewers:
                     if github_username in config["user_ids"]:
                         temp_reviewers.append(config["user_ids"][github_username])
                     else:
@@ -663,7 +1841,7 @@ def reply_pending_mscs(mscs, user=None):
 
                 reviewers = temp_reviewers
 
-            line = "[%s](%s) - *%s*" % (msc.title, msc.html_url, fcp["fcp"]["disposition"])
+            line = "[%s](%s) - *%s*" % (msc.title, msc.html_url, fcp.disposition)
 
             # Convert list to a comma separated string
             reviewers = ", ".join(reviewers)
@@ -686,28 +1864,30 @@ def reply_pending_mscs(mscs, user=None):
 
 def reply_fcp_mscs(mscs):
     """Returns a formatted reply with all MSCs that are in the FCP"""
+    fcp_mscs = [msc_dict["issue"] for msc_dict in mscs["buckets"]["fcp"]]
+
+    # Look up when each FCP started
+    start_times = fetch_concurrently(get_fcp_start, fcp_mscs, fallback=last_known_fcp_start)
+
     fcps = []
-    for msc_dict in mscs:
-        msc = msc_dict["issue"]
-        labels = msc_dict["labels"]
-        if msc_labels["final-comment-period"] in labels:
-            # Figure out remaining days in FCP
-            # Assume last comment by MSCBot was made when FCP started
-            comments = msc.get_comments()
-            for comment in list(comments)[::-1]:  # Iterate from newest comments
-                # Check mscbot user id (retrieve from `curl -A 'mscbot' https://api.github.com/users/mscbot`) 
-                if comment.user.id == 40832866:
-                    time = comment.created_at - timedelta(days=1)
-                    break
-
-            remaining_days = config["msc"]["fcp_length"] - (datetime.today() - time).days
-            line = "[%s](%s)" % (msc.title, msc.html_url)
-            if remaining_days > 0:
-                line += " - Ends in **%d %s**" % (
-                remaining_days, "day" if remaining_days == 1 else "days")
-            else:
-                line += " - Ends **today**"
+    for msc, start_time in zip(fcp_mscs, start_times):
+        # Figure out remaining days in FCP
+        line = "[%s](%s)" % (msc.title, msc.html_url)
+        if start_time is None:
+            line += " - End date unknown"
             fcps.append(line)
+            continue
+
+        # Counted in UTC calendar days, so the count changes at midnight like
+        # the render cache key does
+        today = utc_naive(datetime.now(timezone.utc)).date()
+        remaining_days = config["msc"]["fcp_length"] - (today - start_time.date()).days
+        if remaining_days > 0:
+            line += " - Ends in **%d %s**" % (
+            remaining_days, "day" if remaining_days == 1 else "days")
+        else:
+            line += " - Ends **today**"
+        fcps.append(line)
 
     response = "\n\n**In Final Comment Period**\n\n"
     if len(fcps) > 0:
@@ -718,13 +1898,58 @@ def reply_fcp_mscs(mscs):
     return response
 
 
-def reply_all_mscs(mscs):
-    """Returns a formatted reply with MSCs that are proposed, pending or in FCP. Used as daily message."""
-    global client
+def find_fcp_start(issue):
+    """
+    Searches the comments of an issue, newest first, for the last one made by
+    MSCBot and returns the time the FCP started. Returns None if there is no
+    such comment.
+    """
+    # Assume last comment by MSCBot was made when FCP started
+    for comment in issue.get_comments().reversed:
+        if comment.user.id == mscbot_user_id:
+            return utc_naive(comment.created_at) - timedelta(days=1)
+    return None
+
+
+def get_fcp_start(issue):
+    """
+    Returns the time the FCP of an issue started, or None if unknown. Comments
+    are only searched again if the issue was updated since the last search.
+    """
+    global fcp_start_index
+
+    updated_at = utc_naive(issue.updated_at).isoformat()
+    entry = fcp_start_index.get(str(issue.number))
+    count_cache_lookup("fcp_start", entry is not None and entry["updated_at"] == updated_at)
+    if entry is None or entry["updated_at"] != updated_at:
+        try:
+            start_time = find_fcp_start(issue)
+        except GithubBudgetExhausted:
+            return last_known_fcp_start(issue)
+        entry = {"updated_at": updated_at,
+                 "start": start_time.isoformat() if start_time else None}
+        fcp_start_index[str(issue.number)] = entry
+
+    if entry["start"] is None:
+        return None
+    return datetime.fromisoformat(entry["start"])
+
+
+def last_known_fcp_start(issue):
+    """
+    Returns the FCP start time of an issue found before it was last updated,
+    or None if it was never found. Used when Github's rate limit is too low
+    to search its comments again
+    """
+    log_warn("Github rate limit is low, not searching comments of", issue.number, trace=False)
+    entry = fcp_start_index.get(str(issue.number))
+    if entry is None or entry["start"] is None:
+        return None
+    return datetime.fromisoformat(entry["start"])
 
-    # Sort MSCs by ID
-    mscs = sorted(mscs, key=lambda msc: msc["issue"].number)
 
+def reply_all_mscs(mscs):
+    """Returns a formatted reply with MSCs that are proposed, pending or in FCP. Used as daily message."""
     # Display active MSCs by status: proposed, fcp pending, and fcp
     response = "# Today's MSC Status\n\n"
     response += reply_in_progress_mscs(mscs)
@@ -733,6 +1958,7 @@ def reply_all_mscs(mscs):
     return response
 
 
+@command_handler("SHOW_TASKS", needs=("snapshot",), cached=True)
 def reply_tasks(room_id, arguments, mscs):
     """
     Returns a formatted reply with in-progress MSCs that everyone should look
@@ -753,6 +1979,7 @@ def reply_tasks(room_id, arguments, mscs):
     return response
 
 
+@command_handler("SHOW_NEWS", needs=("snapshot",))
 def reply_news(room_id, arguments, mscs):
     """Generates a report for MSC status changes over a given time period"""
 
@@ -765,14 +1992,9 @@ def reply_news(room_id, arguments, mscs):
         until_time = "now"
 
         # Get last TWIM blog post time from RSS
-        try:
-            feed = feedparser.parse(
-                "https://matrix.org/blog/category/this-week-in-matrix/feed/")
-            from_time = feed["entries"][0]["published"]
-            from_time = parser.parse(from_time).replace(tzinfo=None)
-        except:
-            log_warn("Feed parsing error")
-            return "Unable to parse last TWIM post date"
+        from_time = get_last_twim_post()
+        if from_time is None:
+            return "Unable to retrieve last TWIM post date"
     else:
         # Time range syntax. e.g "from <time> to <time>"
         if len(arguments) >= 4 and arguments[0] == "from":
@@ -804,7 +2026,9 @@ def reply_news(room_id, arguments, mscs):
         return err_string
 
     # Download github events for each msc
-    issue_events = get_label_events([i["issue"] for i in mscs], from_time, until_time).values()
+    issue_events, skipped = get_label_events([i["issue"] for i in mscs["mscs"]],
+                                             from_time, until_time)
+    issue_events = issue_events.values()
 
     approved_labels = ["finished-final-comment-period",
                        "spec-pr-missing",
@@ -856,173 +2080,1776 @@ def reply_news(room_id, arguments, mscs):
     if get_room_setting(room_id, "priority_mscs"):
         response += "\n\nBe aware that there are priority MSCs enabled in this room, and that you may not be seeing all available MSC news."
 
+    if skipped > 0:
+        response += "\n\n_Github's rate limit is running low, so news of %d MSCs may be missing._" % skipped
+
     return response
 
 
-def get_label_events(issues, date_from, date_to):
+def get_last_twim_post():
     """
-    Retrieves github label-added events for a list of github issues within a
-    specified time period
+    Returns the date of the last TWIM post, or None if it is not known. The
+    date is kept up to date in the background, so this only waits on the feed
+    if it has never been retrieved.
     """
-    # list of (issue: "label-name")
-    global msc_labels
+    if twim_cache["published"] is None:
+        refresh_twim_feed()
+    return twim_cache["published"]
 
-    # Iterate through issues and retrieve their event timelines
-    issue_states = {}
-    for i in issues:
-        labels = set()
-        for e in i.get_events():
-            # Make sure this is a label-change event
-            if e.event != 'labeled':
-                continue
 
-            # Make sure this is a label we actually care about
-            if e.label.name not in config["github"]["labels"]:
-                continue
+def refresh_twim_feed():
+    """
+    Revalidate the cached date of the last TWIM post against the RSS feed.
+    The feed is only downloaded and parsed again if it changed. On failure,
+    the last known date is kept.
+    """
+    global twim_session
 
-            # Label was added at some point
-            labels.add(e.label.name)
+    if twim_session is None:
+        twim_session = requests.Session()
 
-            # Ignore events not in the requested time period
-            if e.created_at < date_from or e.created_at >= date_to:
-                continue
+    headers = {}
+    if twim_cache["etag"]:
+        headers["If-None-Match"] = twim_cache["etag"]
+    if twim_cache["last_modified"]:
+        headers["If-Modified-Since"] = twim_cache["last_modified"]
 
-            # Get date event occured
-            date = e.created_at.date()
+    try:
+        with track_request("twim"):
+            r = twim_session.get(get_config("twim", "feed_url",
+                                            "https://matrix.org/blog/category/this-week-in-matrix/feed/"),
+                                 headers=headers, timeout=get_config("twim", "timeout", 10))
+        count_cache_lookup("twim", r.status_code == 304)
+        if r.status_code == 304:
+            return
+        r.raise_for_status()
 
-            # Record this label change with a date.
-            # Could be overwritten by later state changes if they too ocurred
-            # in the requested time period
-            issue_states[i.number] = {"issue": i, "date": date, "label": e.label.name}
+        feed = feedparser.parse(r.content)
+        published = parser.parse(feed["entries"][0]["published"]).replace(tzinfo=None)
+    except Exception:
+        log_warn("Unable to retrieve TWIM feed")
+        return
 
-    return issue_states
+    twim_cache.update(published=published, etag=r.headers.get("ETag"),
+                      last_modified=r.headers.get("Last-Modified"))
+    log_info("Last TWIM post was published", published)
 
 
-def get_mscs(room_id=None):
+async def refresh_twim_forever():
+    """Revalidate the last TWIM post date every [twim] refresh_interval seconds"""
+    while True:
+        await loop.run_in_executor(None, refresh_twim_feed)
+        await asyncio.sleep(get_config("twim", "refresh_interval", 3600))
+
+
+@command_handler("SHOW_STATS", needs=("snapshot",), cached=True)
+def reply_stats(room_id, arguments, mscs):
     """
-    Get up to date MSC metadata from Github.
-    If room_id is set, and that room has priority MSCs set, only metadata
-    about those MSCs will be returned
+    Returns how long MSCs spend in each lifecycle stage, how many MSCs
+    entered each stage per month over the last few months, and how long
+    open MSCs have been in their current stage
     """
-    global github
-    global repo
-    global msc_labels
+    months = 6
+    if len(arguments) > 0:
+        try:
+            months = max(1, min(int(arguments[0]), 36))
+        except ValueError:
+            return "Usage: `show stats [months]`"
+
+    # Make sure the events of open MSCs are indexed
+    skipped = update_event_index([msc["issue"] for msc in mscs["mscs"]])
+    index = get_lifecycle_index()
+    stages = index["stages"]
+
+    response = "**Time spent in each stage** (median / 90th percentile)\n\n"
+    for stage, next_stage in zip(lifecycle_stages, lifecycle_stages[1:]):
+        # Comparisons with NaN are False, so MSCs that didn't reach both stages drop out
+        days = [(left - entered) / 86400 for entered, left in zip(stages[stage], stages[next_stage])
+                if left >= entered]
+        response += "* %s → %s: " % (stage_names[stage], stage_names[next_stage])
+        if len(days) == 0:
+            response += "*no MSCs*\n"
+            continue
+        days.sort()
+        response += "%.1f / %.1f days (%d MSCs)\n" % (
+            statistics.median(days), percentile(days, 0.9), len(days))
+
+    # Count the MSCs entering each stage per calendar month
+    now = datetime.now(timezone.utc)
+    month_keys = []
+    year, month = now.year, now.month
+    for _ in range(months):
+        month_keys.insert(0, "%04d-%02d" % (year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    since = datetime.strptime(month_keys[0], "%Y-%m").replace(tzinfo=timezone.utc).timestamp()
+
+    counts = {stage: Counter(datetime.fromtimestamp(entered, timezone.utc).strftime("%Y-%m")
+                             for entered in stages[stage] if entered >= since)
+              for stage in lifecycle_stages}
+    response += "\n**MSCs entering each stage per month**\n\n<pre><code>"
+    response += "%-8s %s\n" % ("month", " ".join("%10s" % stage_columns[stage]
+                                                for stage in lifecycle_stages))
+    for month_key in month_keys:
+        response += "%-8s %s\n" % (month_key, " ".join("%10d" % counts[stage][month_key]
+                                                        for stage in lifecycle_stages))
+    response += "</code></pre>\n"
+
+    # Ages of open MSCs in the stage they are currently in
+    positions = {number: i for i, number in enumerate(index["numbers"])}
+    ages = {stage: [] for stage in lifecycle_stages}
+    for msc in mscs["mscs"]:
+        reached = [stage for stage in lifecycle_stages if stage in msc["labels"]]
+        position = positions.get(msc["issue"].number)
+        if len(reached) == 0 or position is None:
+            continue
+        entered = stages[reached[-1]][position]
+        if entered == entered:  # Not NaN
+            ages[reached[-1]].append(((now.timestamp() - entered) / 86400, msc["issue"]))
 
-    # Download issues/pulls from github with active MSC labels
-    issues = []
-    for issue in repo.get_issues(labels=list([msc_labels["proposal"]])):
-        # Check if a room ID with priority MSCs was provided
-        # Filter out any mscs that aren't a priority for this room
-        if room_id:
-            priority_mscs = get_room_setting(room_id, "priority_mscs")
-            if priority_mscs and issue.number not in priority_mscs:
+    response += "\n**Time open MSCs have been in their current stage**\n\n"
+    for stage in lifecycle_stages[:-1]:
+        if len(ages[stage]) == 0:
+            continue
+        ages[stage].sort(key=lambda age: age[0])
+        oldest_days, oldest = ages[stage][-1]
+        response += "* %s: %d MSCs, median %.0f days, longest [%s](%s) at %.0f days\n" % (
+            stage_names[stage], len(ages[stage]),
+            statistics.median(age for age, _ in ages[stage]),
+            oldest.title.strip(), oldest.html_url, oldest_days)
+
+    response += "\nBased on the label history of %d MSCs." % len(index["numbers"])
+    if skipped > 0:
+        response += "\n\n_Github's rate limit is running low, so %d MSCs may be out of date._" % skipped
+    return response
+
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of a sorted list of values"""
+    return values[max(math.ceil(fraction * len(values)) - 1, 0)]
+
+
+def get_lifecycle_index():
+    """
+    Returns when each MSC in the event index first entered each lifecycle
+    stage, rebuilt only when the event index has changed.
+
+    The index is column-oriented, so statistics are computed a column at a
+    time over all MSCs. It is a dictionary of:
+        "numbers": array of MSC numbers
+        "stages": stage label to array of unix timestamps, in the same order
+            as "numbers", with NaN where the MSC never reached the stage
+    """
+    global lifecycle_index
+
+    with event_index_lock:
+        if lifecycle_index is not None and lifecycle_index["version"] == event_index_version:
+            return lifecycle_index
+
+        numbers = array("l")
+        stages = {stage: array("d") for stage in lifecycle_stages}
+        for number, entry in event_index.items():
+            entered = {}
+            for created_at, label in sorted(entry["events"] + entry.get("webhook_events", [])):
+                if label in stages and label not in entered:
+                    entered[label] = created_at
+            if len(entered) == 0:
                 continue
 
-        issues.append(issue)
+            numbers.append(int(number))
+            for stage, column in stages.items():
+                if stage in entered:
+                    column.append(datetime.fromisoformat(entered[stage])
+                                  .replace(tzinfo=timezone.utc).timestamp())
+                else:
+                    column.append(math.nan)
 
-        # Create a list relating an issue to its possible FCP information (FCP info added later)
-    issues = [({"issue": issue,
-                "labels": list(issue.labels),
-                "fcp": None}) for issue in issues]
+        lifecycle_index = {"version": event_index_version, "numbers": numbers, "stages": stages}
+        return lifecycle_index
 
-    # Link issues to metadata from MSCBot
-    r = requests.get(config['mscbot']['url'] + "/api/all")
-    fcp_info = r.json()
-    for issue in issues:
-        # Link MSC to FCP metadata if currently in proposed FCP
-        if msc_labels["proposed-final-comment-period"] in issue["labels"]:
-            for fcp in fcp_info:
-                if issue["issue"].number == fcp["issue"]["number"]:
-                    issue["fcp"] = fcp
 
-    return issues
+@command_handler("SHOW_SEARCH", needs=("snapshot",), cached=True)
+def reply_search(room_id, arguments, mscs):
+    """Returns the open MSCs best matching the search terms"""
+    if len(arguments) == 0:
+        return "Usage: `search (terms)`"
+
+    snapshot = get_snapshot()
+    update_search_index(snapshot)
+    numbers = set(msc["issue"].number for msc in mscs["mscs"])
+    results = [msc for msc in search_mscs(snapshot, " ".join(arguments))
+               if msc["issue"].number in numbers][:10]
+    if len(results) == 0:
+        return "No MSCs found matching '%s'." % " ".join(arguments)
+
+    response = "**MSCs matching '%s'**\n\n" % " ".join(arguments)
+    for msc in results:
+        status = [stage_names[stage] for stage in lifecycle_stages if stage in msc["labels"]]
+        response += "* [%s](%s) - %s\n" % (msc["issue"].title.strip(), msc["issue"].html_url,
+                                           status[-1] if status else "Proposal")
+    return response
 
-def pillify(text):
-    """Convert Matrix IDs to pills"""
-    return pill_regex.sub(r'<a href="https://matrix.to/#/@\1:\2.\3">\1</a>', text)
 
+def search_terms(text):
+    """Splits text into lowercase search terms"""
+    return search_term_regex.findall((text or "").lower())
 
-def main():
-    global client
-    global config
-    global github
-    global repo
-    global msc_labels
-    global logger
-    global room_specific_data
 
-    # Retrieve login information from config file
-    with open("config.toml", "r") as f:
-        try:
-            config = toml.loads(f.read())
-        except:
-            log_fatal("Error reading config file:")
+def update_search_index(snapshot):
+    """
+    Brings the search index up to date with a snapshot. Only MSCs that were
+    added or updated since the index was last updated are tokenized again,
+    and MSCs that are no longer open are removed.
+    """
+    with search_index_lock:
+        if search_index["version"] == snapshot["version"]:
             return
 
-    # Configure logging
-    # Determine whether we are using a logfile or not
-    logging_format = "[%(levelname)s] %(asctime)s: %(message)s"
-    if "logfile" in config["logging"]:
-        logging.basicConfig(
-            level=logging.INFO if config["logging"]["level"] != "DEBUG" else logging.DEBUG,
-            format=logging_format,
-            filename=config["logging"]["logfile"])
-    else:
-        logging.basicConfig(
-            level=logging.INFO if config["logging"]["level"] != "DEBUG" else logging.DEBUG,
-            format=logging_format)
-    logger = logging.getLogger()
+        docs = search_index["docs"]
+        open_numbers = set()
+        for msc in snapshot["mscs"]:
+            issue = msc["issue"]
+            open_numbers.add(issue.number)
+            updated_at = utc_naive(issue.updated_at).isoformat()
+            doc = docs.get(issue.number)
+            if doc is not None and doc["updated_at"] == updated_at:
+                continue
 
-    # Retrieve room-specific data if config file exists
-    if "data_filepath" in config["bot"]:
-        data_filepath = config["bot"]["data_filepath"]
-        if os.path.exists(config["bot"]["data_filepath"]):
-            with open(data_filepath, 'r') as f:
-                room_specific_data = json.loads(f.read())
+            terms = Counter()
+            for field, text in (("title", issue.title), ("body", issue.body),
+                                ("labels", " ".join(msc["labels"]))):
+                for term in search_terms(text):
+                    terms[term] += search_field_weights[field]
 
-    # Schedule daily summary messages per-room
-    for room_id in room_specific_data.keys():
-        # Check if summaries are enabled in this room
-        if get_room_setting(room_id, "summary_enabled") == False:
-            continue
+            remove_search_doc(issue.number)
+            add_search_doc(issue.number, {"updated_at": updated_at, "terms": dict(terms)})
 
-        # Check if this room has a custom summary time
-        if get_room_setting(room_id, "summary_time"):
-            # Set a scheduler for that time
-            # Tag with the room ID so we can easily cancel later if necessary
-            schedule.every().day.at(config["bot"]["daily_summary_time"]).do(send_summary,
-                                                                            room_id).tag(
-                room_id)
+        for number in [number for number in docs if number not in open_numbers]:
+            remove_search_doc(number)
 
-    # Schedule daily summary messages to rooms that do not have a custom time
-    set_up_default_summaries()
+        search_index["version"] = snapshot["version"]
 
-    # Login to Github
-    github = Github(config["github"]["token"])
-    repo = github.get_repo(config["github"]["repo"])
-    log_info("Connected to Github")
 
-    # Get MSC-related label objects from specified Github repository
-    labels = config["github"]["labels"]
-    msc_labels = {label.name: label for label in repo.get_labels() if label.name in labels}
+def add_search_doc(number, doc):
+    """Adds an MSC to the search index. Must be called with search_index_lock held"""
+    doc["length"] = sum(doc["terms"].values())
+    search_index["docs"][number] = doc
+    search_index["total_length"] += doc["length"]
+    for term, frequency in doc["terms"].items():
+        search_index["postings"].setdefault(term, {})[number] = frequency
+
+
+def remove_search_doc(number):
+    """Removes an MSC from the search index. Must be called with search_index_lock held"""
+    doc = search_index["docs"].pop(number, None)
+    if doc is None:
+        return
+
+    search_index["total_length"] -= doc["length"]
+    for term in doc["terms"]:
+        postings = search_index["postings"][term]
+        del postings[number]
+        if len(postings) == 0:
+            del search_index["postings"][term]
+
+
+def search_mscs(snapshot, query):
+    """
+    Returns the MSCs in the snapshot matching a query, best match first. MSCs
+    are ranked by BM25 over the search index, after any MSCs whose number is
+    in the query.
+    """
+    by_number = {msc["issue"].number: msc for msc in snapshot["mscs"]}
+    terms = search_terms(query)
+
+    # Looking up an MSC by number
+    exact = []
+    for term in terms:
+        number = term[3:] if term.startswith("msc") else term
+        if number.isdigit() and int(number) in by_number:
+            exact.append(int(number))
+    exact = list(dict.fromkeys(exact))
+
+    k1 = 1.2
+    b = 0.75
+    scores = Counter()
+    with search_index_lock:
+        docs = search_index["docs"]
+        if len(docs) > 0:
+            average_length = search_index["total_length"] / len(docs)
+            for term in set(terms):
+                postings = search_index["postings"].get(term, {})
+                idf = math.log(1 + (len(docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+                for number, frequency in postings.items():
+                    length = docs[number]["length"]
+                    scores[number] += idf * frequency * (k1 + 1) / (
+                        frequency + k1 * (1 - b + b * length / average_length))
+
+    exact_numbers = set(exact)
+    ranked = exact + [number for number, _ in scores.most_common()
+                      if number not in exact_numbers]
+    return [by_number[number] for number in ranked if number in by_number]
+
+
+def get_github_pool(priority):
+    """
+    Returns the thread pool used for per-issue Github requests of a priority
+    class. Each class has its own pool, so requests of one never queue behind
+    those of another before reaching the gate. See github_request_slot()
+    """
+    global github_pools
+
+    if priority not in github_pools:
+        github_pools[priority] = ThreadPoolExecutor(
+            max_workers=get_config("github", "max_concurrency", 4),
+            thread_name_prefix="github-" + priority)
+    return github_pools[priority]
+
+
+class GithubBudgetExhausted(Exception):
+    """
+    Raised instead of making a Github request when the rate limit is too low
+    for the request's priority class
+    """
+
+
+class github_priority:
+    """
+    Context manager making the Github requests of the current thread in a
+    priority class (see github_priorities)
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+
+    def __enter__(self):
+        self.previous = getattr(github_context, "priority", None)
+        github_context.priority = self.priority
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        github_context.priority = self.previous
+
+
+def current_github_priority():
+    """Returns the priority class of the current thread's Github requests"""
+    return getattr(github_context, "priority", None) or "command"
+
+
+class github_request_slot:
+    """
+    Context manager making room for a Github request. Raises
+    GithubBudgetExhausted if the rate limit of resource is down to what the
+    current priority class must leave for others. Otherwise waits until fewer
+    than [github] max_concurrency requests are in flight, letting waiting
+    requests of more important classes go first.
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+
+    def __enter__(self):
+        global github_requests_in_flight
+
+        priority = current_github_priority()
+        budget = github_budget.get(self.resource)
+        if budget is not None and time.time() < budget["reset"]:
+            reserve = get_config("github", "budget_reserve", {}).get(
+                priority, github_default_reserves[priority])
+            if budget["remaining"] <= reserve:
+                raise GithubBudgetExhausted(
+                    "%d Github %s requests left, not making %s requests" %
+                    (budget["remaining"], self.resource, priority))
+
+        max_in_flight = get_config("github", "max_concurrency", 4)
+        with github_gate:
+            ticket = (github_priorities[priority], next(github_gate_tickets))
+            heapq.heappush(github_gate_waiting, ticket)
+            while (github_requests_in_flight >= max_in_flight or
+                   github_gate_waiting[0] != ticket):
+                github_gate.wait()
+            heapq.heappop(github_gate_waiting)
+            github_requests_in_flight += 1
+            # The next waiting request may be able to go too
+            github_gate.notify_all()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global github_requests_in_flight
+
+        with github_gate:
+            github_requests_in_flight -= 1
+            github_gate.notify_all()
+
+
+def update_github_budget(headers):
+    """Record the rate limit Github reported in the headers of a response"""
+    if "x-ratelimit-remaining" not in headers:
+        return
+
+    resource = headers.get("x-ratelimit-resource", "core")
+    github_budget[resource] = {"remaining": int(headers["x-ratelimit-remaining"]),
+                               "reset": int(headers.get("x-ratelimit-reset", 0))}
+    set_gauge("mscbot_github_rate_limit_remaining", {"resource": resource},
+              github_budget[resource]["remaining"])
+
+
+def call_github(func, *args):
+    """
+    Calls func with args, waiting and retrying if Github reports that a
+    secondary rate limit was hit. The back off applies to every thread making
+    requests, not just the one that was told off.
+    """
+    global github_backoff_until
+
+    max_attempts = get_config("github", "max_attempts", 5)
+    for attempt in range(1, max_attempts + 1):
+        delay = github_backoff_until - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        try:
+            return func(*args)
+        except RateLimitExceededException as e:
+            headers = e.headers or {}
+
+            # The primary rate limit only resets hourly. Don't wait on it
+            if headers.get("x-ratelimit-remaining") == "0" or attempt == max_attempts:
+                raise
+
+            # Honour Retry-After if given, otherwise back off exponentially
+            if "retry-after" in headers:
+                delay = int(headers["retry-after"])
+            else:
+                delay = min(2 ** attempt, 60)
+            log_warn("Hit Github secondary rate limit, backing off for %d seconds" % delay,
+                     trace=False)
+            github_backoff_until = max(github_backoff_until, time.time() + delay)
+
+
+def fetch_concurrently(func, items, fallback=None):
+    """
+    Calls func on each item using the Github thread pool, with at most
+    [github] max_concurrency requests in flight. Results are returned in the
+    same order as items.
+
+    Items that are still rate limited once call_github() gives up, because
+    the primary rate limit ran out or retries did, get fallback(item) as
+    their result instead, or None if there is no fallback.
+    """
+    # Carry the caller's priority class over to the pool's threads
+    priority = current_github_priority()
+
+    def call(item):
+        with github_priority(priority):
+            try:
+                return call_github(func, item)
+            except RateLimitExceededException:
+                return fallback(item) if fallback else None
+
+    if len(items) == 0:
+        return []
+    if len(items) == 1:
+        return [call(items[0])]
+
+    return list(get_github_pool(priority).map(call, items))
+
+
+def utc_naive(date):
+    """Converts a possibly timezone-aware datetime to a naive UTC datetime"""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+def fetch_new_label_events(issue, entry):
+    """
+    Retrieves the label-added events of a github issue that are newer than
+    the high-water mark of its event index entry (or all of them if entry is
+    None). Returns the updated entry.
+    """
+    if entry is None or entry["seen"] is None:
+        # Never indexed, or indexed by the GraphQL backend which does not
+        # track how many events it has seen. Start from scratch
+        entry = {"updated_at": None, "seen": 0, "events": []}
+
+    # Issue events are returned oldest first, so skip straight to the page
+    # holding the first event we have not seen yet
+    per_page = github.per_page
+    page_number = entry["seen"] // per_page
+    skip = entry["seen"] % per_page
+
+    paginated_events = issue.get_events()
+    seen = page_number * per_page
+    events = list(entry["events"])
+    while True:
+        page = paginated_events.get_page(page_number)
+        for e in page[skip:]:
+            # Make sure this is a label we actually care about being added
+            if e.event == 'labeled' and e.label.name in config["github"]["labels"]:
+                events.append([utc_naive(e.created_at).isoformat(), e.label.name])
+        seen += len(page)
+        if len(page) < per_page:
+            break
+        page_number += 1
+        skip = 0
+
+    return {"updated_at": utc_naive(issue.updated_at).isoformat(),
+            "seen": seen,
+            "events": events}
+
+
+def update_event_index(issues):
+    """
+    Brings the event index up to date for a list of github issues. Only
+    issues that have been updated since they were last indexed cost any API
+    calls. The index is saved to disk if anything changed.
+
+    Events are fetched as news backfill, the least important Github
+    requests. Returns the number of issues left out of date because the
+    rate limit ran low.
+    """
+    global event_index
+
+    with event_index_lock:
+        if cluster_enabled():
+            load_shared_event_index()
+
+        # Only note what is out of date while holding the lock. Fetching can
+        # take a while, and other rooms and webhooks need the index meanwhile
+        stale = []
+        for i in issues:
+            entry = event_index.get(str(i.number))
+            if entry and entry["updated_at"] == utc_naive(i.updated_at).isoformat():
+                continue
+            stale.append((i, entry))
+
+    count_cache_lookup("event_index", True, len(issues) - len(stale))
+    count_cache_lookup("event_index", False, len(stale))
+    if len(stale) == 0:
+        return 0
+
+    def fetch_entry(stale_entry):
+        try:
+            return fetch_new_label_events(*stale_entry)
+        except GithubBudgetExhausted:
+            return None
+
+    with github_priority("backfill"):
+        entries = fetch_concurrently(fetch_entry, stale)
+
+    skipped = 0
+    with event_index_lock:
+        for (i, old_entry), entry in zip(stale, entries):
+            if entry is None:
+                skipped += 1
+                continue
+            event_index[str(i.number)] = merge_event_index_entry(
+                event_index.get(str(i.number)), old_entry, entry)
+
+        event_index_changed()
+
+    if skipped > 0:
+        log_warn("Github rate limit is low, left events of %d issues out of date" % skipped,
+                 trace=False)
+    return skipped
+
+
+def merge_event_index_entry(current, old, fetched):
+    """
+    Returns the entry of an issue to keep in the event index, after fetching
+    its events starting from old. The index may have moved on meanwhile,
+    through webhooks or another thread, so whichever entry has the newer
+    high-water mark is kept. Webhook events newer than the fetched entry are
+    carried over to it.
+    """
+    if current is None or current is old:
+        return fetched
+    if (current["updated_at"] or "") > (fetched["updated_at"] or ""):
+        return current
+
+    newer = [event for event in current.get("webhook_events", [])
+             if event[0] > fetched["updated_at"]]
+    if len(newer) > 0:
+        return dict(fetched, webhook_events=newer)
+    return fetched
+
+
+def event_index_changed():
+    """
+    Record that the event index changed, and save it to disk. Must be called
+    with event_index_lock held
+    """
+    global event_index_version
+
+    event_index_version += 1
+    save_event_index()
+
+
+def save_event_index():
+    """Saves the event index to disk, and shares it with the cluster"""
+    if cluster_enabled():
+        try:
+            store_put("event_index", json.dumps(event_index).encode())
+        except:
+            log_warn("Unable to share event index with the cluster")
+
+    data_filepath = get_config("cache", "event_index_filepath")
+    if not data_filepath:
+        return
+
+    try:
+        write_json_atomically(data_filepath, event_index)
+    except:
+        log_warn("Unable to save event index to disk")
+
+
+def load_shared_event_index():
+    """
+    Merge in the entries other workers of the cluster added to the event
+    index, keeping whichever entry of an issue is the most up to date. Must
+    be called with event_index_lock held
+    """
+    global event_index_version
+
+    try:
+        shared = store_get("event_index", cluster_revisions.get("event_index", 0))
+        if shared is None:
+            return
+        entries = json.loads(shared[1])
+    except:
+        log_warn("Unable to load event index shared by the cluster")
+        return
+
+    changed = False
+    for number, entry in entries.items():
+        ours = event_index.get(number)
+        if ours is None or (entry["updated_at"] or "") > (ours["updated_at"] or ""):
+            event_index[number] = entry
+            changed = True
+    cluster_revisions["event_index"] = shared[0]
+
+    if changed:
+        event_index_version += 1
+
+
+def load_event_index():
+    """Loads the event index from disk if it exists"""
+    global event_index
+
+    data_filepath = get_config("cache", "event_index_filepath")
+    if not data_filepath or not os.path.exists(data_filepath):
+        return
+
+    try:
+        with open(data_filepath, 'r') as f:
+            event_index = json.loads(f.read())
+    except:
+        log_warn("Unable to read event index, rebuilding it")
+        event_index = {}
+
+
+def get_label_events(issues, date_from, date_to):
+    """
+    Retrieves github label-added events for a list of github issues within a
+    specified time period. Returns a tuple of the events, and the number of
+    issues whose events may be out of date.
+    """
+    skipped = update_event_index(issues)
+
+    date_from = date_from.isoformat()
+    date_to = date_to.isoformat()
+
+    issue_states = {}
+    for i in issues:
+        entry = event_index.get(str(i.number))
+        if not entry:
+            continue
+
+        # Include events we've only heard about through webhooks so far
+        for created_at, label in entry["events"] + entry.get("webhook_events", []):
+            # Ignore events not in the requested time period
+            if created_at < date_from or created_at >= date_to:
+                continue
+
+            # Record this label change with a date.
+            # Could be overwritten by later state changes if they too ocurred
+            # in the requested time period
+            date = datetime.fromisoformat(created_at).date()
+            issue_states[i.number] = {"issue": i, "date": date, "label": label}
+
+    return issue_states, skipped
+
+
+def fetch_msc_issue_pages(cached_pages):
+    """
+    Download all open issues/pulls with the proposal label, a page at a time.
+
+    Each page is requested with the ETag it was served with last time, so
+    pages that have not changed are answered with a 304, which does not count
+    against the Github rate limit. cached_pages is the list of
+    (etag, raw issue list) tuples returned by the previous call.
+
+    Returns a tuple of (pages, changed).
+    """
+    global github
+    global repo
+
+    per_page = 100
+    pages = []
+    changed = False
+    page_number = 1
+    while True:
+        headers = {}
+        cached = None
+        if page_number <= len(cached_pages):
+            cached = cached_pages[page_number - 1]
+            headers["If-None-Match"] = cached[0]
+
+        response_headers, data = github.requester.requestJsonAndCheck(
+            "GET", repo.url + "/issues",
+            parameters={"labels": msc_labels["proposal"].name, "state": "open",
+                        "per_page": per_page, "page": page_number},
+            headers=headers)
+
+        if data is None and cached is not None:
+            # 304 Not Modified
+            page = cached
+        else:
+            page = (response_headers.get("etag"), data)
+            changed = True
+
+        pages.append(page)
+        if len(page[1]) < per_page:
+            break
+        page_number += 1
+
+    # The list got shorter since the last refresh
+    if len(pages) != len(cached_pages):
+        changed = True
+
+    return pages, changed
+
+
+def parse_fcp_record(item):
+    """Converts an FCP entry from the MSCBot API into an FcpRecord"""
+    return FcpRecord(
+        issue_number=item["issue"]["number"],
+        disposition=item["fcp"]["disposition"],
+        reviews=tuple(FcpReview(login=user["login"], approved=approved)
+                      for user, approved in item["reviews"]))
+
+
+def fetch_fcp_records():
+    """
+    Retrieves proposed FCPs from MSCBot as a dictionary of issue number to
+    FcpRecord. The previous response is revalidated with a conditional
+    request, and returned as-is if MSCBot reports it unchanged.
+    """
+    global mscbot_session
+    global mscbot_cache
+
+    if mscbot_session is None:
+        mscbot_session = requests.Session()
+
+    headers = {}
+    if mscbot_cache["etag"]:
+        headers["If-None-Match"] = mscbot_cache["etag"]
+    if mscbot_cache["last_modified"]:
+        headers["If-Modified-Since"] = mscbot_cache["last_modified"]
+
+    with track_request("mscbot"):
+        r = mscbot_session.get(config['mscbot']['url'] + "/api/all", headers=headers,
+                               timeout=get_config("mscbot", "timeout", 10))
+    count_cache_lookup("mscbot", r.status_code == 304)
+    if r.status_code == 304:
+        return mscbot_cache["records"]
+    r.raise_for_status()
+
+    records = {}
+    for item in r.json():
+        record = parse_fcp_record(item)
+        records[record.issue_number] = record
+
+    mscbot_cache = {"etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "records": records}
+    return records
+
+
+def fetch_msc_issues_rest(snapshot):
+    """
+    Download all open MSC issues/pulls through the Github REST API. Returns a
+    tuple of (issues, cache), where issues is None if nothing changed since
+    the given snapshot was taken.
+    """
+    cached_pages = snapshot["cache"] if snapshot else []
+    pages, changed = fetch_msc_issue_pages(cached_pages)
+    if snapshot and not changed:
+        return None, pages
+
+    issues = [github.create_from_raw_data(Issue, raw) for _, page in pages for raw in page]
+    return issues, pages
+
+
+# Fields selected for each MSC by the GraphQL backend. Shared between issues
+# and pull requests, which are separate types
+graphql_msc_fields = """
+    id
+    number
+    title
+    body
+    url
+    state
+    createdAt
+    updatedAt
+    labels(first: 50) { nodes { name } }
+    timelineItems(itemTypes: [LABELED_EVENT], first: 100) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ... on LabeledEvent { createdAt label { name } } }
+    }
+    comments(last: $comments) {
+      nodes { createdAt author { ... on User { databaseId } } }
+    }
+"""
+
+graphql_mscs_query = """
+query($owner: String!, $name: String!, $labels: [String!], $comments: Int!,
+      $withIssues: Boolean!, $issuesCursor: String,
+      $withPulls: Boolean!, $pullsCursor: String) {
+  repository(owner: $owner, name: $name) {
+    issues(first: 50, after: $issuesCursor, labels: $labels, states: OPEN)
+        @include(if: $withIssues) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...IssueFields }
+    }
+    pullRequests(first: 50, after: $pullsCursor, labels: $labels, states: OPEN)
+        @include(if: $withPulls) {
+      pageInfo { hasNextPage endCursor }
+      nodes { ...PullFields }
+    }
+  }
+}
+fragment IssueFields on Issue { %s }
+fragment PullFields on PullRequest { %s }
+""" % (graphql_msc_fields, graphql_msc_fields)
+
+# Label events are paged through separately for MSCs with more than fit in
+# graphql_msc_fields. Timeline connections of issues and pull requests are
+# separate types, so the selection is repeated for each
+graphql_label_events_fields = """
+  pageInfo { hasNextPage endCursor }
+  nodes { ... on LabeledEvent { createdAt label { name } } }
+"""
+
+graphql_label_events_query = """
+query($id: ID!, $cursor: String) {
+  node(id: $id) {
+    ... on Issue {
+      timelineItems(itemTypes: [LABELED_EVENT], first: 100, after: $cursor) { %s }
+    }
+    ... on PullRequest {
+      timelineItems(itemTypes: [LABELED_EVENT], first: 100, after: $cursor) { %s }
+    }
+  }
+}
+""" % (graphql_label_events_fields, graphql_label_events_fields)
+
+
+def parse_github_time(timestamp):
+    """Converts a Github API timestamp to a naive UTC datetime"""
+    return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%SZ")
+
+
+def graphql_query(query, variables):
+    """Runs a query against the Github GraphQL API and returns its data"""
+    global graphql_session
+
+    if graphql_session is None:
+        graphql_session = requests.Session()
+        graphql_session.headers["Authorization"] = "bearer " + config["github"]["token"]
+
+    with github_request_slot("graphql"), track_request("github_graphql"):
+        r = graphql_session.post(
+            get_config("github", "graphql_url", "https://api.github.com/graphql"),
+            json={"query": query, "variables": variables},
+            timeout=get_config("github", "timeout", 30))
+    update_github_budget(r.headers)
+    r.raise_for_status()
+    response = r.json()
+    if response.get("errors"):
+        raise Exception("GraphQL query failed: %s" % response["errors"])
+    return response["data"]
+
+
+def graphql_label_events(node):
+    """
+    Returns the [timestamp, label name] pairs of the label-added events of a
+    GraphQL issue or pull request node, fetching any further pages of events
+    """
+    connection = node["timelineItems"]
+    events = []
+    while True:
+        for e in connection["nodes"]:
+            # Make sure this is a label we actually care about
+            if e and e["label"]["name"] in config["github"]["labels"]:
+                events.append([parse_github_time(e["createdAt"]).isoformat(),
+                               e["label"]["name"]])
+
+        if not connection["pageInfo"]["hasNextPage"]:
+            return events
+        data = graphql_query(graphql_label_events_query,
+                             {"id": node["id"], "cursor": connection["pageInfo"]["endCursor"]})
+        connection = data["node"]["timelineItems"]
+
+
+def fetch_msc_issues_graphql(snapshot):
+    """
+    Download all open MSC issues/pulls through the Github GraphQL API, along
+    with their label-added events and latest comments, in a handful of
+    paginated queries. The event index and FCP start index are filled in
+    from the same data, so they need no further requests.
+
+    Returns a tuple of (issues, cache), where issues is None if nothing
+    changed since the given snapshot was taken.
+    """
+    global event_index
+    global fcp_start_index
+
+    owner, name = config["github"]["repo"].split("/")
+    variables = {"owner": owner, "name": name,
+                 "labels": [msc_labels["proposal"].name],
+                 "comments": get_config("github", "graphql_comments", 20),
+                 "withIssues": True, "issuesCursor": None,
+                 "withPulls": True, "pullsCursor": None}
+
+    # Page through issues and pull requests side by side
+    nodes = []
+    while variables["withIssues"] or variables["withPulls"]:
+        repository = graphql_query(graphql_mscs_query, variables)["repository"]
+        for kind in ("issues", "pulls"):
+            connection = repository.get("issues" if kind == "issues" else "pullRequests")
+            if connection is None:
+                continue
+            nodes += [(kind, node) for node in connection["nodes"]]
+            variables[kind + "Cursor"] = connection["pageInfo"]["endCursor"]
+            variables["with" + kind.capitalize()] = connection["pageInfo"]["hasNextPage"]
+
+    # Newest first, the same order the REST API lists them in
+    nodes.sort(key=lambda n: n[1]["number"], reverse=True)
+
+    fingerprint = [[node["number"], node["updatedAt"],
+                    sorted(label["name"] for label in node["labels"]["nodes"])]
+                   for _, node in nodes]
+    if snapshot and fingerprint == snapshot["cache"]:
+        return None, fingerprint
+
+    issues = []
+    events = {}
+    for kind, node in nodes:
+        # Convert to the shape the REST API uses, so the rest of the bot can
+        # treat these like any other issue
+        api_url = "%s/issues/%d" % (repo.url, node["number"])
+        raw = {"number": node["number"],
+               "title": node["title"],
+               "body": node["body"],
+               "html_url": node["url"],
+               "url": api_url,
+               "state": node["state"].lower(),
+               "created_at": node["createdAt"],
+               "updated_at": node["updatedAt"],
+               "labels": [{"name": label["name"],
+                           "url": "%s/labels/%s" % (repo.url, quote(label["name"]))}
+                          for label in node["labels"]["nodes"]]}
+        if kind == "pulls":
+            raw["pull_request"] = {"html_url": node["url"]}
+        issues.append(github.create_from_raw_data(Issue, raw))
+
+        updated_at = parse_github_time(node["updatedAt"]).isoformat()
+        events[str(node["number"])] = {"updated_at": updated_at,
+                                       "seen": None,
+                                       "events": graphql_label_events(node)}
+
+        # Assume last comment by MSCBot was made when FCP started
+        for comment in node["comments"]["nodes"][::-1]:
+            if (comment["author"] or {}).get("databaseId") == mscbot_user_id:
+                start_time = parse_github_time(comment["createdAt"]) - timedelta(days=1)
+                fcp_start_index[str(node["number"])] = {"updated_at": updated_at,
+                                                        "start": start_time.isoformat()}
+                break
+
+    with event_index_lock:
+        event_index.update(events)
+        event_index_changed()
+
+    return issues, fingerprint
+
+
+def fetch_msc_issues(snapshot):
+    """
+    Download all open MSC issues/pulls using the configured Github backend.
+    Returns a tuple of (issues, cache), where issues is None if nothing
+    changed since the given snapshot was taken, and cache is backend-specific
+    data to be kept in the snapshot for the next call.
+    """
+    if get_config("github", "backend", "rest") == "graphql":
+        return fetch_msc_issues_graphql(snapshot)
+    return fetch_msc_issues_rest(snapshot)
+
+
+def refresh_snapshot(snapshot):
+    """
+    Build a new MSC snapshot, reusing anything from the given (possibly None)
+    snapshot that Github reports as unchanged.
+    """
+    global msc_labels
+
+    issues, cache = fetch_msc_issues(snapshot)
+
+    # Link issues to metadata from MSCBot
+    fcp_records = fetch_fcp_records()
+
+    if snapshot and issues is None and fcp_records == snapshot["fcp_records"]:
+        # Nothing changed. Keep the same version so anything derived from it
+        # stays valid
+        return dict(snapshot, fetched_at=time.time(), synced_at=time.time(), stale=None)
+
+    if issues is None:
+        issues = [msc["issue"] for msc in snapshot["mscs"]]
+
+    version = snapshot["version"] + 1 if snapshot else 1
+    log_info("Built MSC snapshot version", version, "with", len(issues), "MSCs")
+    return build_snapshot(issues, fcp_records, version, cache)
+
+
+def build_snapshot(issues, fcp_records, version, cache):
+    """Builds a snapshot out of a list of Github issues and MSCBot FCP records"""
+    # Create a list relating an issue to its possible FCP information
+    mscs = [({"issue": issue,
+              "labels": frozenset(label.name for label in issue.labels),
+              "fcp": None}) for issue in issues]
+
+    for msc in mscs:
+        # Link MSC to FCP metadata if currently in proposed FCP
+        if "proposed-final-comment-period" in msc["labels"]:
+            msc["fcp"] = fcp_records.get(msc["issue"].number)
+
+    return dict(build_msc_view(mscs),
+                version=version,
+                fetched_at=time.time(),
+                synced_at=time.time(),
+                stale=None,
+                cache=cache,
+                fcp_records=fcp_records)
+
+
+def save_warm_snapshot(snapshot):
+    """
+    Saves an MSC snapshot to [cache] snapshot_filepath, along with the label
+    map, FCP start index and search index, so that a restarted bot can answer
+    from it straight away. See load_warm_snapshot()
+    """
+    filepath = get_config("cache", "snapshot_filepath")
+    if not filepath:
+        return
+
+    try:
+        write_json_atomically(filepath, snapshot_data(snapshot), compress=True)
+    except:
+        log_warn("Unable to save MSC snapshot to disk")
+
+
+def snapshot_data(snapshot):
+    """
+    Returns an MSC snapshot, the label map, FCP start index and search index
+    in a form that can be saved as JSON. See restore_snapshot_data()
+    """
+    update_search_index(snapshot)
+
+    backend = get_config("github", "backend", "rest")
+    issues = [msc["issue"] for msc in snapshot["mscs"]]
+    cache = snapshot["cache"]
+    if backend == "rest":
+        # Cached pages mostly hold the same issues as the snapshot, so only
+        # store those once
+        raw_issues = {issue.number: issue.raw_data for issue in issues}
+        cache = [[etag, [raw["number"] if raw_issues.get(raw["number"]) == raw else raw
+                         for raw in page]]
+                 for etag, page in cache]
+
+    data = {"format": 1,
+            "repo": config["github"]["repo"],
+            "backend": backend,
+            "version": snapshot["version"],
+            "labels": [{"name": label.name, "url": label.url} for label in msc_labels.values()],
+            "issues": [issue.raw_data for issue in issues],
+            "cache": cache,
+            "fcp_records": [[record.issue_number, record.disposition,
+                             [list(review) for review in record.reviews]]
+                            for record in snapshot["fcp_records"].values()],
+            "fcp_start_index": dict(fcp_start_index),
+            "search_index": search_index_data()}
+    return data
+
+
+def load_warm_snapshot():
+    """
+    Loads the MSC snapshot, label map and FCP start index saved by
+    save_warm_snapshot(), if there is a snapshot for the configured repository
+    and backend. The snapshot is served as if fresh until it is revalidated.
+    See revalidate_snapshot().
+
+    Returns whether a snapshot was loaded.
+    """
+    global msc_snapshot
+    global msc_labels
+
+    filepath = get_config("cache", "snapshot_filepath")
+    if not filepath or not os.path.exists(filepath):
+        return False
+
+    try:
+        with open(filepath, 'rb') as f:
+            data = json.loads(gzip.decompress(f.read()))
+        if not snapshot_data_matches(data):
+            log_info("Ignoring saved MSC snapshot of a different configuration")
+            return False
+
+        labels, snapshot = restore_snapshot_data(data)
+    except:
+        log_warn("Unable to read saved MSC snapshot, starting without it")
+        return False
+
+    msc_labels = labels
+    # Flagged as stale until it has been revalidated
+    msc_snapshot = dict(snapshot, synced_at=os.path.getmtime(filepath), stale="restarted")
+    log_info("Loaded saved MSC snapshot version", data["version"], "with",
+             len(snapshot["mscs"]), "MSCs")
+    return True
+
+
+def snapshot_data_matches(data):
+    """
+    Returns whether snapshot_data() was saved for the configured repository
+    and backend
+    """
+    return (data["format"] == 1 and data["repo"] == config["github"]["repo"] and
+            data["backend"] == get_config("github", "backend", "rest"))
+
+
+def restore_snapshot_data(data):
+    """
+    Restores the output of snapshot_data(). Returns a tuple of the label map
+    and MSC snapshot, and merges the FCP start index and search index into
+    this process's
+    """
+    labels = {raw["name"]: github.create_from_raw_data(Label, raw)
+              for raw in data["labels"]}
+    issues = [github.create_from_raw_data(Issue, raw) for raw in data["issues"]]
+    cache = data["cache"]
+    if data["backend"] == "rest":
+        raw_issues = {issue.number: issue.raw_data for issue in issues}
+        cache = [[etag, [raw_issues[raw] if isinstance(raw, int) else raw
+                         for raw in page]]
+                 for etag, page in cache]
+    fcp_records = {number: FcpRecord(number, disposition,
+                                     tuple(FcpReview(*review) for review in reviews))
+                   for number, disposition, reviews in data["fcp_records"]}
+
+    fcp_start_index.update(data["fcp_start_index"])
+    load_search_index(data.get("search_index"))
+    return labels, build_snapshot(issues, fcp_records, data["version"], cache)
+
+
+def search_index_data():
+    """Returns the search index in a form that can be saved as JSON"""
+    with search_index_lock:
+        return {"version": search_index["version"],
+                "docs": [[number, doc["updated_at"], doc["terms"]]
+                         for number, doc in search_index["docs"].items()]}
+
+
+def load_search_index(data):
+    """
+    Restores the search index from search_index_data(). Only the documents are
+    saved, so the postings are rebuilt from them without tokenizing anything
+    """
+    if not data:
+        return
+
+    with search_index_lock:
+        search_index.update(version=data["version"], docs={}, postings={}, total_length=0)
+        for number, updated_at, terms in data["docs"]:
+            add_search_doc(number, {"updated_at": updated_at, "terms": terms})
+
+
+def revalidate_snapshot():
+    """
+    Refresh the label map and MSC snapshot from Github whatever the age of the
+    snapshot. Commands are answered from the old snapshot in the meantime.
+    """
+    global msc_labels
+    global msc_snapshot
+
+    with github_priority("refresh"):
+        try:
+            labels = config["github"]["labels"]
+            msc_labels = {label.name: label for label in repo.get_labels()
+                          if label.name in labels}
+        except:
+            log_warn("Unable to refresh MSC labels")
+
+    with snapshot_lock, github_priority("refresh"):
+        snapshot = msc_snapshot
+        try:
+            msc_snapshot = refresh_snapshot(snapshot)
+        except:
+            log_warn("Unable to revalidate saved MSC snapshot")
+            return
+
+        if msc_snapshot["version"] != snapshot["version"]:
+            save_warm_snapshot(msc_snapshot)
+
+
+def get_snapshot():
+    """
+    Returns the shared MSC snapshot, refreshing it first if it is older than
+    the configured TTL.
+
+    A snapshot is a dictionary with a "version" number, which only changes
+    when the underlying data does, and the MSCs in the form of a view (see
+    build_msc_view()).
+
+    In a cluster, the leader keeps the snapshot fresh and shares it. Other
+    workers only refresh it themselves if the leader has fallen behind by
+    more than a lease.
+    """
+    global msc_snapshot
+
+    ttl = snapshot_ttl()
+    snapshot = msc_snapshot
+    fresh = snapshot and time.time() - snapshot["fetched_at"] < ttl
+    count_cache_lookup("snapshot", fresh)
+    if fresh:
+        return snapshot
+
+    with snapshot_lock:
+        # Another thread may have refreshed while we waited for the lock
+        snapshot = msc_snapshot
+        if snapshot and time.time() - snapshot["fetched_at"] < ttl:
+            return snapshot
+
+        if cluster_enabled():
+            snapshot = load_shared_snapshot()
+            age = time.time() - snapshot["fetched_at"] if snapshot else None
+            if snapshot and (age < ttl or not is_leader() and
+                             age < ttl + get_config("cluster", "lease_duration", 30)):
+                return snapshot
+
+        try:
+            msc_snapshot = refresh_snapshot(snapshot)
+        except Exception as e:
+            if snapshot is None:
+                raise
+            # Serve the old data rather than nothing, saying how old it is
+            if isinstance(e, (GithubBudgetExhausted, RateLimitExceededException)):
+                log_warn("Github rate limit is low, using MSC snapshot version",
+                         snapshot["version"], "-", e, trace=False)
+                stale = "rate_limited"
+            else:
+                log_warn("Unable to refresh MSC snapshot, using version", snapshot["version"])
+                stale = "unavailable"
+            msc_snapshot = dict(snapshot, fetched_at=time.time(), stale=stale)
+            publish_snapshot(msc_snapshot)
+            return msc_snapshot
+
+        if snapshot is None or msc_snapshot["version"] != snapshot["version"]:
+            save_warm_snapshot(msc_snapshot)
+        publish_snapshot(msc_snapshot)
+        return msc_snapshot
+
+
+def snapshot_ttl():
+    """Returns the number of seconds the MSC snapshot is fresh for"""
+    if get_config("webhook", "enabled", False):
+        # Webhooks keep the snapshot up to date. Only poll to reconcile
+        return get_config("webhook", "reconcile_interval", 900)
+    return get_config("cache", "snapshot_ttl", 60)
+
+
+def publish_snapshot(snapshot):
+    """
+    Share an MSC snapshot with the other workers of the cluster. The
+    snapshot itself is only written if it changed since it was last shared,
+    otherwise only when it was fetched is.
+    """
+    global shared_snapshot_version
+
+    if not cluster_enabled():
+        return
+
+    try:
+        if snapshot["version"] != shared_snapshot_version:
+            store_put("snapshot", gzip.compress(json.dumps(snapshot_data(snapshot)).encode()))
+            shared_snapshot_version = snapshot["version"]
+        store_put("snapshot_status", json.dumps({"fetched_at": snapshot["fetched_at"],
+                                                 "synced_at": snapshot["synced_at"],
+                                                 "stale": snapshot["stale"]}).encode())
+    except:
+        log_warn("Unable to share MSC snapshot with the cluster")
+
+
+def load_shared_snapshot():
+    """
+    Replace the MSC snapshot with the one shared by the cluster, if it
+    changed since this worker last shared or loaded one. Returns the MSC
+    snapshot, which is None if nobody has fetched one yet.
+    """
+    global msc_snapshot
+    global msc_labels
+    global shared_snapshot_version
+
+    try:
+        shared = store_get("snapshot", cluster_revisions.get("snapshot", 0))
+        if shared is not None:
+            data = json.loads(gzip.decompress(shared[1]))
+            if snapshot_data_matches(data):
+                labels, snapshot = restore_snapshot_data(data)
+                # Versions are only ever bumped, so that responses cached for
+                # an older version are never served for this one
+                version = max(snapshot["version"],
+                              msc_snapshot["version"] + 1 if msc_snapshot else 0)
+                msc_labels = labels
+                msc_snapshot = dict(snapshot, version=version)
+                shared_snapshot_version = version
+                log_info("Loaded MSC snapshot version", version, "shared by the cluster")
+            cluster_revisions["snapshot"] = shared[0]
+
+        status = store_get("snapshot_status")
+        if msc_snapshot is not None and status is not None:
+            msc_snapshot = dict(msc_snapshot, **json.loads(status[1]))
+    except:
+        log_warn("Unable to load MSC snapshot shared by the cluster")
+    return msc_snapshot
+
+
+def get_mscs(room_id=None):
+    """
+    Get up to date MSC metadata from the shared snapshot, as a view (see
+    build_msc_view()).
+    If room_id is set, and that room has priority MSCs set, only metadata
+    about those MSCs will be returned
+    """
+    snapshot = get_snapshot()
+
+    # Check if a room ID with priority MSCs was provided
+    # Filter out any mscs that aren't a priority for this room
+    if room_id:
+        return filter_priority_mscs(snapshot, get_room_setting(room_id, "priority_mscs"))
+    return snapshot
+
+
+def build_msc_view(mscs):
+    """
+    Sorts a list of MSCs into status buckets, so replies don't need to
+    classify MSCs themselves. Returns a view, a dictionary of:
+        "mscs": the MSCs, in the order Github returned them
+        "sorted": the MSCs, sorted by number
+        "buckets": status name to list of MSCs with that status, sorted by
+            number. Statuses are "in-progress", "pending-fcp", "fcp" and
+            "finished" (passed final comment period)
+    """
+    sorted_mscs = sorted(mscs, key=lambda msc: msc["issue"].number)
+    buckets = {"in-progress": [], "pending-fcp": [], "fcp": [], "finished": []}
+    for msc in sorted_mscs:
+        labels = msc["labels"]
+        if "proposal-in-review" in labels:
+            buckets["in-progress"].append(msc)
+        if "proposed-final-comment-period" in labels:
+            buckets["pending-fcp"].append(msc)
+        if "final-comment-period" in labels:
+            buckets["fcp"].append(msc)
+        if (labels.isdisjoint(active_msc_labels) or
+                "finished-final-comment-period" in labels):
+            buckets["finished"].append(msc)
+
+    return {"mscs": mscs, "sorted": sorted_mscs, "buckets": buckets}
+
+
+def filter_priority_mscs(view, priority_mscs):
+    """
+    Returns a view of only the priority MSCs out of a view, or the same view
+    if none are set
+    """
+    if not priority_mscs:
+        return view
+
+    priority_mscs = set(priority_mscs)
+
+    def keep(mscs):
+        return [msc for msc in mscs if msc["issue"].number in priority_mscs]
+
+    return {"mscs": keep(view["mscs"]),
+            "sorted": keep(view["sorted"]),
+            "buckets": {status: keep(mscs) for status, mscs in view["buckets"].items()}}
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Receives Github webhooks and applies them to the MSC snapshot"""
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        # Make sure the payload was signed with our secret
+        secret = config["webhook"]["secret"].encode()
+        signature = "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature, self.headers.get("X-Hub-Signature-256", "")):
+            log_warn("Rejected webhook with an invalid signature", trace=False)
+            self.send_response(401)
+            self.end_headers()
+            return
+
+        event = self.headers.get("X-GitHub-Event")
+        try:
+            apply_webhook(event, json.loads(body))
+        except:
+            log_warn("Unable to apply %s webhook" % event)
+            self.send_response(500)
+            self.end_headers()
+            return
+
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("Webhook server: " + format % args)
+
+
+def start_webhook_server():
+    """Start receiving Github webhooks in a background thread"""
+    # Anyone could sign payloads with an empty secret
+    if not get_config("webhook", "secret", ""):
+        log_fatal("[webhook] secret must be set when webhooks are enabled", trace=False)
+        sys.exit(1)
+
+    address = (get_config("webhook", "host", "127.0.0.1"), get_config("webhook", "port", 8090))
+    server = ThreadingHTTPServer(address, WebhookHandler)
+    threading.Thread(target=server.serve_forever, name="webhook", daemon=True).start()
+    log_info("Listening for Github webhooks on %s:%d" % address)
+
+
+def apply_webhook(event, payload):
+    """
+    Applies a Github issues, pull_request or issue_comment webhook to the MSC
+    snapshot, event index and FCP start index
+    """
+    global fcp_start_index
+
+    # Ignore pings and events from other repos
+    repository = payload.get("repository", {}).get("full_name", "")
+    if repository.lower() != config["github"]["repo"].lower():
+        return
+
+    if event == "issues" or event == "issue_comment":
+        raw = payload["issue"]
+    elif event == "pull_request":
+        raw = pull_request_to_issue(payload["pull_request"])
+    else:
+        return
+
+    issue = github.create_from_raw_data(Issue, raw)
+    action = payload.get("action")
+    log_info("Received %s %s webhook for #%d" % (event, action, issue.number))
+
+    if action == "labeled" and payload["label"]["name"] in config["github"]["labels"]:
+        add_webhook_label_event(issue, payload["label"]["name"])
+
+    if (event == "issue_comment" and action == "created" and
+            payload["comment"]["user"]["id"] == mscbot_user_id):
+        # Assume last comment by MSCBot was made when FCP started
+        start_time = parse_github_time(payload["comment"]["created_at"]) - timedelta(days=1)
+        fcp_start_index[str(issue.number)] = {
+            "updated_at": utc_naive(issue.updated_at).isoformat(),
+            "start": start_time.isoformat()}
+
+    # A deleted comment leaves its issue in place
+    update_snapshot_issue(issue, removed=event != "issue_comment" and action == "deleted")
+
+
+def pull_request_to_issue(pull):
+    """Converts a pull request from a webhook payload to the REST issue shape"""
+    raw = {key: pull[key] for key in
+           ("number", "title", "body", "html_url", "state", "created_at",
+            "updated_at", "labels", "user")}
+    raw["url"] = "%s/issues/%d" % (repo.url, pull["number"])
+    raw["pull_request"] = {"html_url": pull["html_url"]}
+    return raw
+
+
+def add_webhook_label_event(issue, label):
+    """
+    Records a label-added event received through a webhook in the event
+    index. It is kept apart from the events fetched from Github, and replaced
+    by them the next time the issue's events are fetched.
+    """
+    global event_index
+
+    # The webhook doesn't say when the label was added, but it was what
+    # last updated the issue
+    updated_at = utc_naive(issue.updated_at).isoformat()
+
+    with event_index_lock:
+        entry = event_index.get(str(issue.number))
+        if entry is None:
+            entry = {"updated_at": None, "seen": 0, "events": []}
+
+        entry = dict(entry, webhook_events=entry.get("webhook_events", []) + [[updated_at, label]])
+
+        # If the index was up to date before this change, it still is
+        old_msc = find_snapshot_msc(issue.number)
+        if (old_msc and entry["updated_at"] ==
+                utc_naive(old_msc["issue"].updated_at).isoformat()):
+            entry["updated_at"] = updated_at
+
+        event_index[str(issue.number)] = entry
+        event_index_changed()
+
+
+def find_snapshot_msc(number):
+    """Returns the MSC with the given number from the snapshot, if it is there"""
+    snapshot = msc_snapshot
+    if snapshot is None:
+        return None
+
+    for msc in snapshot["mscs"]:
+        if msc["issue"].number == number:
+            return msc
+    return None
+
+
+def update_snapshot_issue(issue, removed=False):
+    """
+    Replaces an issue in the MSC snapshot with a newer copy, adds it if it
+    just became an open MSC, or removes it if it no longer is one. The
+    snapshot version is bumped so cached responses are rebuilt.
+    """
+    global msc_snapshot
+
+    with snapshot_lock:
+        snapshot = msc_snapshot
+        if snapshot is None:
+            # Nothing to update. The first fetch will be up to date
+            return
+
+        labels = frozenset(label.name for label in issue.labels)
+        mscs = list(snapshot["mscs"])
+        index = next((i for i, msc in enumerate(mscs) if msc["issue"].number == issue.number),
+                     None)
+        if index is not None:
+            del mscs[index]
+
+        if not removed and issue.state == "open" and msc_labels["proposal"].name in labels:
+            msc = {"issue": issue, "labels": labels, "fcp": None}
+            if "proposed-final-comment-period" in labels:
+                msc["fcp"] = snapshot["fcp_records"].get(issue.number)
+            # Keep its place, or list it first like the newest issue
+            mscs.insert(index or 0, msc)
+        elif index is None:
+            return
+
+        msc_snapshot = dict(snapshot, version=snapshot["version"] + 1, **build_msc_view(mscs))
+        log_info("Updated MSC snapshot to version", msc_snapshot["version"], "from webhook")
+        publish_snapshot(msc_snapshot)
+
+
+async def reconcile_forever():
+    """
+    Refresh the MSC snapshot every [webhook] reconcile_interval seconds, to
+    catch any changes that webhooks missed. In a cluster, the leader also
+    refreshes it as soon as it expires, so the other workers always find it
+    fresh.
+    """
+    while True:
+        if cluster_enabled():
+            await asyncio.sleep(min(snapshot_ttl(), get_config("cluster", "sync_interval", 5)))
+        else:
+            await asyncio.sleep(snapshot_ttl())
+        if not is_leader():
+            continue
+        try:
+            await loop.run_in_executor(command_pool, reconcile_snapshot)
+        except Exception:
+            log_warn("Unable to reconcile MSC snapshot")
+
+
+def reconcile_snapshot():
+    """Refresh the MSC snapshot if it is due, as a background refresh"""
+    with github_priority("refresh"):
+        get_snapshot()
+
+
+def pillify(text):
+    """Convert Matrix IDs to pills"""
+    return pill_regex.sub(r'<a href="https://matrix.to/#/@\1:\2.\3">\1</a>', text)
+
+
+async def sync_forever():
+    """
+    Long-poll the homeserver for events continuously, without blocking the
+    event loop. The homeserver holds each /sync open until there are new
+    events, so commands are picked up as soon as they are delivered. The
+    timeout never runs past the next scheduled job.
+    """
+    while True:
+        timeout = get_config("matrix", "sync_timeout", 30)
+        next_job = seconds_until_next_job()
+        if next_job is not None:
+            timeout = max(min(timeout, next_job), 1)
+
+        try:
+            with track_request("matrix_sync"):
+                await loop.run_in_executor(None, client.listen_for_events, int(timeout * 1000))
+        except Exception:
+            log_warn("Unable to contact /sync")
+            await asyncio.sleep(config["matrix"]["sync_interval"])  # Wait a few seconds before retrying
+
+
+async def monitor_loop_lag():
+    """
+    Measure how late the event loop wakes up from a sleep, which is how long
+    anything else queued on it has to wait
+    """
+    while True:
+        start = loop.time()
+        await asyncio.sleep(1)
+        observe("mscbot_loop_lag_seconds", {}, max(loop.time() - start - 1, 0))
+
+
+async def run_scheduler():
+    """Run scheduled jobs as they fall due, sleeping until the next one"""
+    while True:
+        run_due_summaries()
+
+        # Sleep until the next job, or until the schedule changes
+        try:
+            await asyncio.wait_for(scheduler_wakeup.wait(), timeout=seconds_until_next_job())
+        except asyncio.TimeoutError:
+            pass
+        scheduler_wakeup.clear()
+
+
+async def run_bot():
+    """Runs the bot's tasks on the event loop until interrupted"""
+    global loop
+    global command_pool
+    global scheduler_wakeup
+    global outbound_slots
+
+    loop = asyncio.get_running_loop()
+    scheduler_wakeup = asyncio.Event()
+    outbound_slots = asyncio.Semaphore(get_config("matrix", "send_concurrency", 4))
+    command_pool = ThreadPoolExecutor(max_workers=get_config("bot", "command_workers", 8),
+                                      thread_name_prefix="command")
+
+    # Schedule daily summary messages per-room
+    restore_summary_schedule()
+
+    # Answer from the saved snapshot while catching up with Github. In a
+    # cluster, catching up is left to the leader
+    if msc_snapshot is not None and not cluster_enabled():
+        loop.run_in_executor(command_pool, revalidate_snapshot).add_done_callback(
+            log_background_error)
+
+    tasks = [sync_forever(), run_scheduler(), refresh_twim_forever()]
+    if get_config("webhook", "enabled", False):
+        start_webhook_server()
+    if get_config("webhook", "enabled", False) or cluster_enabled():
+        tasks.append(reconcile_forever())
+    if cluster_enabled():
+        tasks.append(sync_cluster_forever())
+    if get_config("metrics", "enabled", False):
+        start_metrics_server()
+        tasks.append(monitor_loop_lag())
+
+    await asyncio.gather(*tasks)
+
+
+def connect_github():
+    """
+    Set up the Github client, repository and MSC label map, from the
+    cluster's shared snapshot or the saved snapshot if there is one
+    """
+    global github
+    global repo
+    global msc_labels
+
+    github = Github(config["github"]["token"],
+                    base_url=get_config("github", "base_url", "https://api.github.com"))
+    instrument_github(github)
+
+    if cluster_enabled() and load_shared_snapshot() or load_warm_snapshot():
+        # Labels came with the saved snapshot. Github is only contacted once
+        # the bot is up and serving it
+        repo = github.get_repo(config["github"]["repo"], lazy=True)
+    else:
+        repo = github.get_repo(config["github"]["repo"])
+        log_info("Connected to Github")
+
+        # Get MSC-related label objects from specified Github repository
+        labels = config["github"]["labels"]
+        msc_labels = {label.name: label for label in repo.get_labels() if label.name in labels}
+
+
+def main():
+    global client
+    global homeserver
+    global config
+    global logger
+    global room_specific_data
+
+    # Retrieve login information from config file
+    with open("config.toml", "r") as f:
+        try:
+            config = toml.loads(f.read())
+        except:
+            log_fatal("Error reading config file:")
+            return
+
+    # Configure logging
+    # Determine whether we are using a logfile or not
+    logging_format = "[%(levelname)s] %(asctime)s: %(message)s"
+    if "logfile" in config["logging"]:
+        logging.basicConfig(
+            level=logging.INFO if config["logging"]["level"] != "DEBUG" else logging.DEBUG,
+            format=logging_format,
+            filename=config["logging"]["logfile"])
+    else:
+        logging.basicConfig(
+            level=logging.INFO if config["logging"]["level"] != "DEBUG" else logging.DEBUG,
+            format=logging_format)
+    logger = logging.getLogger()
+
+    # Join the other workers, if this is one of several
+    if cluster_enabled():
+        connect_cluster()
+
+    # Retrieve room-specific data if config file exists
+    load_room_data()
+
+    # Retrieve previously indexed Github events
+    load_event_index()
+
+    # Login to Github
+    connect_github()
 
     # Login to Matrix and listen for messages
-    homeserver = "https://" + config["matrix"]["user_id"].split(":")[-1]
+    homeserver = get_config("matrix", "homeserver",
+                            "https://" + config["matrix"]["user_id"].split(":")[-1])
     client = MatrixClient(homeserver, user_id=config["matrix"]["user_id"],
                           token=config["matrix"]["token"])
     client.add_invite_listener(invite_received)
     client.add_listener(event_received, event_type="m.room.message")
     log_info("Connected to Matrix")
 
-    # Sync continuously and check time for daily summary sending
-    while True:
-        try:
-            client.listen_for_events()
-        except:
-            log_warn("Unable to contact /sync")
-        schedule.run_pending()
-        time.sleep(config["matrix"]["sync_interval"])  # Wait a few seconds between syncs
-
+    # Hand over to the event loop
+    asyncio.run(run_bot())
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+A fake Github GraphQL server for trying out the GraphQL backend locally.
+
+It does not parse queries. It answers the MSC listing query the bot sends
+based on its variables, with generated issues and pull requests. Point the
+bot at it with:
+
+    [github]
+    backend = "graphql"
+    graphql_url = "http://localhost:8081/graphql"
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timedelta
+import argparse
+import json
+import re
+
+# Github user ID of mscbot
+mscbot_user_id = 40832866
+
+# Labels MSCs are cycled through
+labels = ["proposal-in-review",
+          "proposed-final-comment-period",
+          "final-comment-period",
+          "finished-final-comment-period"]
+
+# Types of Github's schema that the bot's queries may select fragments on.
+# Queries with fragments on any other type are rejected, like Github does
+schema_types = {"Issue", "PullRequest", "LabeledEvent", "User",
+                "IssueTimelineItemsConnection", "PullRequestTimelineItemsConnection"}
+
+args = None
+
+
+def make_events(number):
+    """Generate the label events of an issue or pull request"""
+    created = datetime(2019, 1, 1) + timedelta(days=number)
+    return [{"createdAt": (created + timedelta(days=i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+             "label": {"name": "proposal" if i == 0 else labels[i % len(labels)]}}
+            for i in range(args.events)]
+
+
+def make_node(number, pull):
+    """Generate an issue or pull request node"""
+    created = datetime(2019, 1, 1) + timedelta(days=number)
+    label = labels[number % len(labels)]
+    comments = [{"createdAt": (created + timedelta(hours=i)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                 "author": {"databaseId": mscbot_user_id if i == args.comments - 1 else 1}}
+                for i in range(args.comments)]
+    return {
+        "id": "node%d" % number,
+        "number": number,
+        "title": "MSC%d: %s %d" % (number, "Pull" if pull else "Issue", number),
+        "body": "Proposal body for MSC%d" % number,
+        "url": "https://github.com/%s/%s/%d" % (args.repo, "pull" if pull else "issues", number),
+        "state": "OPEN",
+        "createdAt": created.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "updatedAt": (created + timedelta(days=30)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "labels": {"nodes": [{"name": "proposal"}, {"name": label}]},
+        "timelineItems": connection(make_events(number), None, page_size=100),
+        "comments": {"nodes": comments},
+    }
+
+
+def unknown_types(query):
+    """Returns the types fragments are selected on in a query that Github doesn't have"""
+    types = re.findall(r"(?:\bfragment\s+\w+\s+on|\.\.\.\s*on)\s+(\w+)", query)
+    return sorted(set(types) - schema_types)
+
+
+def connection(nodes, cursor, page_size=50):
+    """Return a page of nodes starting from the given cursor"""
+    start = int(cursor or 0)
+    end = start + page_size
+    return {"pageInfo": {"hasNextPage": end < len(nodes), "endCursor": str(end)},
+            "nodes": nodes[start:end]}
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        variables = request.get("variables", {})
+
+        unknown = unknown_types(request.get("query", ""))
+        if unknown:
+            self.send_json({"errors": [{"message": "Fragment on unknown type %s" % name}
+                                       for name in unknown]})
+            return
+
+        if "id" in variables:
+            # Follow-up label event pages
+            number = int(variables["id"][len("node"):])
+            data = {"node": {"timelineItems": connection(
+                make_events(number), variables.get("cursor"), page_size=100)}}
+        else:
+            numbers = range(1, args.mscs + 1)
+            issues = [make_node(n, False) for n in numbers if n % 2]
+            pulls = [make_node(n, True) for n in numbers if not n % 2]
+            repository = {}
+            if variables.get("withIssues"):
+                repository["issues"] = connection(issues, variables.get("issuesCursor"))
+            if variables.get("withPulls"):
+                repository["pullRequests"] = connection(pulls, variables.get("pullsCursor"))
+            data = {"repository": repository}
+
+        self.send_json({"data": data})
+
+    def send_json(self, response):
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def main():
+    global args
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--repo", default="matrix-org/matrix-doc")
+    parser.add_argument("--mscs", type=int, default=120, help="Number of open MSCs")
+    parser.add_argument("--events", type=int, default=4, help="Label events per MSC")
+    parser.add_argument("--comments", type=int, default=20, help="Comments per MSC")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("localhost", args.port), Handler)
+    print("Serving fake Github GraphQL API on http://localhost:%d/graphql" % args.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Posts recorded Github webhook payloads to the bot's webhook endpoint, signed
+with the configured secret, for testing webhook ingestion locally.
+
+Each payload file is a JSON object of the form:
+
+    {"event": "issues", "payload": {...}}
+
+where "event" is the X-GitHub-Event header value and "payload" is the body
+Github sent. Files are posted in name order.
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+
+import requests
+import toml
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument("payloads", nargs="*",
+                        default=[os.path.join(os.path.dirname(__file__), "webhook_payloads")],
+                        help="Payload files, or directories of them")
+    parser.add_argument("--config", default="config.toml", help="Bot config file")
+    parser.add_argument("--url", help="Webhook endpoint (default: from config)")
+    args = parser.parse_args()
+
+    with open(args.config, "r") as f:
+        config = toml.loads(f.read())
+    webhook = config.get("webhook", {})
+    url = args.url or "http://%s:%d/" % (webhook.get("host", "127.0.0.1"),
+                                         webhook.get("port", 8090))
+    secret = webhook.get("secret", "").encode()
+
+    filepaths = []
+    for path in args.payloads:
+        if os.path.isdir(path):
+            filepaths += [os.path.join(path, name) for name in sorted(os.listdir(path))
+                          if name.endswith(".json")]
+        else:
+            filepaths.append(path)
+
+    failed = False
+    for filepath in filepaths:
+        with open(filepath, "r") as f:
+            recording = json.loads(f.read())
+
+        body = json.dumps(recording["payload"]).encode()
+        signature = "sha256=" + hmac.new(secret, body, hashlib.sha256).hexdigest()
+        r = requests.post(url, data=body, timeout=10, headers={
+            "Content-Type": "application/json",
+            "X-GitHub-Event": recording["event"],
+            "X-Hub-Signature-256": signature,
+        })
+        print("%s: %s %d" % (os.path.basename(filepath), recording["event"], r.status_code))
+        failed = failed or r.status_code >= 400
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()